@@ -1,18 +1,32 @@
+import ast
 import builtins
-import contextlib
-import io
+import functools
+import hashlib
 import os
 import asyncio
+import concurrent.futures
+import contextvars
 import sys
+import socket
+import threading
+import uuid
+import time
+import weakref
 import json
-from typing import TypedDict, Sequence, Literal, Any, List, Dict
+import re
+import ahocorasick
+import orjson
+from cachetools import LRUCache, TTLCache
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from typing import Annotated, TypedDict, Sequence, Literal, Any, List, Dict
 
 # Langchain/LangGraph Imports
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage, SystemMessage
-from langchain_core.prompts import ChatPromptTemplate # Para prompts mais estruturados
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import BaseTool
 from pydantic import BaseModel, Field # Para definir schemas de args
 from langgraph.graph import StateGraph
+from langgraph.graph.message import add_messages
 
 # Adapters e LLM
 try:
@@ -21,6 +35,7 @@ except ImportError:
     print("ERRO CRÍTICO: Biblioteca 'langchain_mcp_adapters' não encontrada.")
     sys.exit(1)
 from langchain_anthropic import ChatAnthropic
+import anthropic
 
 # Stub
 from stub import CustomAgent
@@ -36,77 +51,627 @@ if not api_key:
 llm = ChatAnthropic(model="claude-3-5-sonnet-20240620", temperature=0.1, api_key=api_key) # Temp baixa para mais determinismo
 print("Modelo Anthropic Claude carregado.")
 
+# --- CONTROLO DE CONCORRÊNCIA DAS CHAMADAS LLM ---
+class AIMDLimiter:
+    """Limite de concorrência adaptativo (AIMD, como no controlo de congestionamento TCP).
+
+    Cada sucesso aumenta o limite em 1/limite (≈ +1 por cada "janela" de chamadas bem-sucedidas);
+    cada rate limit (429) reduz o limite para metade. Usado como `async with limiter:`.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self) -> "AIMDLimiter":
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self) -> None:
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_rate_limit(self) -> None:
+        self.limit = max(self.min_limit, self.limit / 2)
+        print(f"--- [LLM] Rate limit: concorrência reduzida para {int(self.limit)} ---")
+
+# Limite de chamadas LLM concorrentes (vários agentes podem correr em paralelo)
+_LLM_LIMITER = AIMDLimiter(max_limit=int(os.getenv("ANTHROPIC_CONC", "8")))
+
+def _llm_retrying() -> AsyncRetrying:
+    """Política única de repetição das chamadas LLM: backoff exponencial com jitter em rate limits."""
+    return AsyncRetrying(
+        wait=wait_random_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(5),
+        retry=retry_if_exception_type(anthropic.RateLimitError),
+        before_sleep=lambda retry_state: print(f"Rate limit atingido. Tentando novamente em {retry_state.next_action.sleep:.2f} segundos..."),
+        reraise=True,
+    )
+
+async def _ainvoke_guarded(runnable, llm_input_messages: List[BaseMessage]) -> AIMessage:
+    """`ainvoke` limitado pelo AIMDLimiter e repetido com _llm_retrying em rate limits.
+    A espera entre tentativas é feita fora do limitador, para não ocupar uma vaga enquanto se aguarda."""
+    async for attempt in _llm_retrying():
+        with attempt:
+            async with _LLM_LIMITER:
+                try:
+                    response = await runnable.ainvoke(llm_input_messages)
+                except anthropic.RateLimitError:
+                    _LLM_LIMITER.on_rate_limit()
+                    raise
+                _LLM_LIMITER.on_success()
+    return response
+
+def _cached_system_message(text: str) -> SystemMessage:
+    """SystemMessage com breakpoint de prompt caching da Anthropic (cache_control efémero).
+    A Anthropic ordena o prefixo como ferramentas -> system -> mensagens, pelo que o breakpoint
+    no system prompt também cobre as definições de ferramentas passadas com bind_tools."""
+    return SystemMessage(content=[{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}])
+
+# --- CLIENTE MCP (event loop dedicado) ---
+
+class ParallelMultiServerMCPClient(MultiServerMCPClient):
+    """MultiServerMCPClient que arranca e inicializa os servidores em paralelo.
+
+    Cada servidor é ligado por um sub-cliente próprio, numa tarefa própria que mantém o
+    contexto aberto até ao fecho (os transportes stdio exigem entrada e saída na mesma tarefa).
+    O tempo de arranque passa a ser o do servidor mais lento, e não a soma de todos.
+    """
+
+    async def _serve_one(self, server_name: str, connection: dict, ready: asyncio.Future, closing: asyncio.Event) -> None:
+        try:
+            async with MultiServerMCPClient({server_name: connection}) as client:
+                self.sessions.update(client.sessions)
+                self.server_name_to_tools.update(client.server_name_to_tools)
+                ready.set_result(None)
+                await closing.wait()
+        except Exception as e:
+            if ready.done():
+                raise
+            ready.set_exception(e)
+
+    async def __aenter__(self) -> "ParallelMultiServerMCPClient":
+        loop = asyncio.get_running_loop()
+        self._closing = asyncio.Event()
+        ready = {server_name: loop.create_future() for server_name in self.connections}
+        self._server_tasks = [
+            asyncio.create_task(self._serve_one(server_name, connection, ready[server_name], self._closing))
+            for server_name, connection in self.connections.items()
+        ]
+        results = await asyncio.gather(*ready.values(), return_exceptions=True)
+        for server_name, result in zip(ready, results):
+            if isinstance(result, Exception):
+                print(f"AVISO: Falha ao iniciar o servidor MCP '{server_name}': {result}")
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._closing.set()
+        await asyncio.gather(*self._server_tasks, return_exceptions=True)
+
+class AsyncLoopThread(threading.Thread):
+    """Thread que mantém um event loop asyncio próprio a correr indefinidamente."""
+
+    def __init__(self):
+        super().__init__(name="mcp-event-loop", daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+        self.loop.close()
+
+# Transporte dos servidores MCP locais: "stdio" (por omissão) ou "sse" (variável MCP_TRANSPORT).
+# O cliente 0.0.x do langchain-mcp-adapters não suporta streamable-http.
+# O transporte HTTP (SSE) evita o enquadramento por linhas do stdio e não bloqueia chamadas concorrentes;
+# os servidores escutam apenas em 127.0.0.1, mas qualquer processo local pode ligar-se ao porto.
+MCP_TRANSPORT = os.environ.get("MCP_TRANSPORT", "stdio")
+# transporte do servidor -> (transporte no MultiServerMCPClient, caminho do endpoint)
+_HTTP_TRANSPORTS = {"sse": ("sse", "/sse")}
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class LocalMCPServers:
+    """Prepara a configuração de ligação aos servidores MCP locais.
+
+    Com stdio, o próprio cliente lança os processos. Com um transporte HTTP, cada servidor é lançado
+    aqui num porto livre, aguarda-se que aceite ligações e a configuração aponta para o respetivo URL.
+    """
+
+    def __init__(self, server_commands: Dict[str, List[str]], transport: str = MCP_TRANSPORT, startup_timeout: float = 15.0):
+        if transport != "stdio" and transport not in _HTTP_TRANSPORTS:
+            raise ValueError(f"Transporte MCP não suportado: {transport}")
+        self._server_commands = server_commands
+        self._transport = transport
+        self._startup_timeout = startup_timeout
+        self._processes: List[asyncio.subprocess.Process] = []
+
+    async def _wait_until_listening(self, name: str, process: asyncio.subprocess.Process, port: int) -> None:
+        deadline = time.monotonic() + self._startup_timeout
+        while True:
+            if process.returncode is not None:
+                raise RuntimeError(f"Servidor MCP '{name}' terminou com código {process.returncode}")
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                await writer.wait_closed()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Servidor MCP '{name}' não ficou disponível no porto {port}")
+                await asyncio.sleep(0.05)
+
+    async def __aenter__(self) -> dict:
+        if self._transport == "stdio":
+            return {
+                name: {"command": argv[0], "args": argv[1:], "transport": "stdio"}
+                for name, argv in self._server_commands.items()
+            }
+        client_transport, path = _HTTP_TRANSPORTS[self._transport]
+        config, waits = {}, []
+        try:
+            for name, argv in self._server_commands.items():
+                port = _free_port()
+                process = await asyncio.create_subprocess_exec(*argv, "--transport", self._transport, "--port", str(port))
+                self._processes.append(process)
+                config[name] = {"url": f"http://127.0.0.1:{port}{path}", "transport": client_transport}
+                waits.append(self._wait_until_listening(name, process, port))
+            # Os servidores arrancam em paralelo; esperar por todos de uma vez
+            await asyncio.gather(*waits)
+        except BaseException:
+            await self.__aexit__(None, None, None)
+            raise
+        print(f"Servidores MCP locais a correr com transporte {self._transport}: {', '.join(config)}")
+        return config
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        for process in self._processes:
+            if process.returncode is None:
+                process.terminate()
+        for process in self._processes:
+            try:
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        self._processes.clear()
+
+class MCPClientWrapper:
+    """Um único MultiServerMCPClient a viver no loop de uma AsyncLoopThread.
+
+    Todo o ciclo de vida do cliente (entrada e saída do `async with`) corre numa só tarefa
+    desse loop, e as chamadas às ferramentas são submetidas para lá com
+    `run_coroutine_threadsafe`, pelo que vários agentes podem partilhar as mesmas sessões.
+    """
+
+    def __init__(self, server_config: dict, loop_thread: AsyncLoopThread):
+        self._server_config = server_config
+        self._loop_thread = loop_thread
+        self._client: ParallelMultiServerMCPClient | None = None
+        self._ready: concurrent.futures.Future = concurrent.futures.Future()
+        self._closing: asyncio.Event | None = None
+        self._serving: concurrent.futures.Future | None = None
+
+    async def _serve(self) -> None:
+        try:
+            async with ParallelMultiServerMCPClient(self._server_config) as client:
+                self._client = client
+                self._closing = asyncio.Event()
+                self._ready.set_result(None)
+                await self._closing.wait()
+        except Exception as e:
+            if not self._ready.done():
+                self._ready.set_exception(e)
+            raise
+
+    async def __aenter__(self) -> "MCPClientWrapper":
+        self._serving = self._loop_thread.submit(self._serve())
+        await asyncio.wrap_future(self._ready)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._closing is not None:
+            self._loop_thread.loop.call_soon_threadsafe(self._closing.set)
+        if self._serving is not None:
+            await asyncio.wrap_future(self._serving)
+
+    async def list_tools(self) -> List[BaseTool]:
+        # get_tools() é síncrono e apenas devolve as ferramentas já carregadas
+        return self._client.get_tools()
+
+    async def call_tool(self, tool: BaseTool, args: Any) -> Any:
+        return await asyncio.wrap_future(self._loop_thread.submit(tool.ainvoke(args)))
+
+    def call_tool_sync(self, tool: BaseTool, args: Any) -> Any:
+        return self._loop_thread.submit(tool.ainvoke(args)).result()
+
 # --- ESTADO DO AGENTE ---
 class AgentState(TypedDict):
-    messages: Sequence[BaseMessage]
+    # add_messages devolve uma lista nova a cada atualização: snapshots e checkpoints não partilham a mesma lista
+    messages: Annotated[Sequence[BaseMessage], add_messages]
     task_description: str
     retrieved_tool_names: List[str] | None
     agent_outcome: Any | None
-    mcp_client: MultiServerMCPClient | None
-    mcp_tools: Dict[str, BaseTool] | None
+
+# Cliente e ferramentas MCP não fazem parte do estado: chegam aos nós via config["configurable"]
+# ("mcp_client", "mcp_tools"), sem serem copiados a cada transição do grafo
+def _configurable(config: RunnableConfig | None) -> dict:
+    return (config or {}).get("configurable", {})
+
+# --- ERROS ESTRUTURADOS DAS FERRAMENTAS MCP ---
+def _parse_tool_error(result: Any) -> dict | None:
+    """Reconhece o erro estruturado dos servidores MCP locais ({"isError", "code", "retryable", "content"}),
+    quer venha como dicionário quer como o texto JSON entregue pelo adaptador."""
+    if isinstance(result, str):
+        if not result.lstrip().startswith("{"):
+            return None
+        try:
+            result = orjson.loads(result)
+        except orjson.JSONDecodeError:
+            return None
+    if isinstance(result, dict) and result.get("isError") and "code" in result:
+        return result
+    return None
+
+def _tool_error_text(error: dict) -> str:
+    return " ".join(part.get("text", "") for part in error.get("content", []) if isinstance(part, dict)).strip()
+
+def _invocation_error(message: str) -> str:
+    """Falha ao invocar a ferramenta (ex.: ligação ao servidor), no mesmo formato dos erros dos servidores."""
+    return orjson.dumps({
+        "isError": True,
+        "code": "INVOCATION_ERROR",
+        "retryable": True,
+        "content": [{"type": "text", "text": message}],
+    }).decode()
+
+# --- CACHE DE RESULTADOS DE FERRAMENTAS MCP ---
+
+# Ferramentas com efeitos secundários: nunca servidas a partir da cache
+_NON_IDEMPOTENT_TOOLS = frozenset({"write_query"})
+
+class ToolRunCache:
+    """Cache assíncrona (TTL + LRU) de resultados de ferramentas MCP, indexada por (nome, args canónicos).
+
+    Guarda a tarefa em curso antes de a aguardar, para que chamadas duplicadas concorrentes
+    partilhem uma única ida ao servidor MCP. Falhas e erros estruturados transitórios
+    (`retryable`) não ficam em cache.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 300.0):
+        self._store: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get_or_call(self, tool: BaseTool, args: Any, mcp_client: "MCPClientWrapper | None" = None) -> Any:
+        def invoke():
+            return mcp_client.call_tool(tool, args) if mcp_client else tool.ainvoke(args)
+
+        if tool.name in _NON_IDEMPOTENT_TOOLS:
+            # Uma escrita pode invalidar leituras anteriores
+            self.clear()
+            return await invoke()
+
+        key = (tool.name, json.dumps(args, sort_keys=True, default=str))
+        future = self._store.get(key)
+        if future is None:
+            future = asyncio.ensure_future(invoke())
+            self._store[key] = future
+        try:
+            # shield: cancelar um dos chamadores não cancela a chamada partilhada
+            result = await asyncio.shield(future)
+        except Exception:
+            if self._store.get(key) is future:
+                self._store.pop(key, None)
+            raise
+        error = _parse_tool_error(result)
+        if error and error.get("retryable") and self._store.get(key) is future:
+            self._store.pop(key, None)
+        return result
+
+    def clear(self) -> None:
+        self._store.clear()
+
+class _CachedToolProxy:
+    """Expõe uma ferramenta ao código CodeAct com `ainvoke` mediado pela ToolRunCache."""
+
+    def __init__(self, tool: BaseTool, cache: ToolRunCache, mcp_client: MCPClientWrapper | None = None):
+        self._tool = tool
+        self._cache = cache
+        self._mcp_client = mcp_client
+
+    async def ainvoke(self, args: Any, *_, **__) -> Any:
+        return await self._cache.get_or_call(self._tool, args, self._mcp_client)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._tool, name)
+
+tool_run_cache = ToolRunCache()
+
+# --- FORMATAÇÃO DE FERRAMENTAS PARA PROMPTS ---
+
+# Registo das ferramentas MCP por id(), para as caches indexadas por ferramenta
+_TOOL_REGISTRY: "weakref.WeakValueDictionary[int, BaseTool]" = weakref.WeakValueDictionary()
+
+@functools.lru_cache(maxsize=None)
+def _format_tool_for_prompt(tool_id: int, tool_name: str) -> tuple[str, str]:
+    """Devolve (chaves dos argumentos, schema JSON) da ferramenta, calculados uma única vez."""
+    tool = _TOOL_REGISTRY[tool_id]
+
+    # Chaves dos argumentos (usadas no prompt CodeAct)
+    arg_keys_str = ''
+    if tool.args_schema:
+        # Se for dict com 'properties', extrair as chaves
+        if isinstance(tool.args_schema, dict) and 'properties' in tool.args_schema and isinstance(tool.args_schema['properties'], dict):
+             arg_keys_str = ", ".join(tool.args_schema['properties'].keys())
+        # Se for Pydantic model (v1 ou v2), tentar extrair de .schema()
+        elif hasattr(tool.args_schema, 'schema') and callable(tool.args_schema.schema):
+            try:
+                schema_dict = tool.args_schema.schema()
+                if isinstance(schema_dict, dict) and 'properties' in schema_dict and isinstance(schema_dict['properties'], dict):
+                     arg_keys_str = ", ".join(schema_dict['properties'].keys())
+            except Exception: # Captura erros ao chamar .schema()
+                 pass # Mantém arg_keys_str vazio se falhar
+        # Fallback para string se não for reconhecido
+        if not arg_keys_str:
+            arg_keys_str = str(tool.args_schema)
+
+    # Schema JSON completo (usado no prompt ReAct)
+    schema_str = 'Nenhum argumento necessário'
+    if tool.args_schema:
+        # Se for um dict (schema JSON), converter para string JSON
+        if isinstance(tool.args_schema, dict):
+            try:
+                schema_str = orjson.dumps(tool.args_schema).decode()
+            except TypeError: # orjson.JSONEncodeError é subclasse de TypeError
+                schema_str = str(tool.args_schema) # Fallback
+        # Se tiver o método schema_json (Pydantic), usar (compatibilidade futura)
+        elif hasattr(tool.args_schema, 'schema_json'):
+             schema_str = tool.args_schema.schema_json()
+        # Senão, usar representação string
+        else:
+             schema_str = str(tool.args_schema)
+
+    return arg_keys_str, schema_str
+
+def _register_tool(tool: BaseTool) -> int:
+    _TOOL_REGISTRY[id(tool)] = tool
+    return id(tool)
+
+def _tool_prompt_parts(tool: BaseTool) -> tuple[str, str]:
+    return _format_tool_for_prompt(_register_tool(tool), tool.name)
+
+@functools.lru_cache(maxsize=256)
+def _llm_with_tool(tool_id: int, tool_name: str):
+    """LLM com a ferramenta ligada (e escolha forçada), construído uma vez por ferramenta."""
+    tool = _TOOL_REGISTRY[tool_id]
+    return llm.bind_tools([tool], tool_choice=tool.name)
+
+# --- STREAMING DE RESPOSTAS LLM ---
+
+def _chunk_text(chunk: BaseMessage) -> str:
+    """Extrai o texto de um chunk (conteúdo em string ou em lista de blocos)."""
+    if isinstance(chunk.content, str):
+        return chunk.content
+    return "".join(
+        block if isinstance(block, str) else block.get("text", "")
+        for block in chunk.content
+        if isinstance(block, str) or block.get("type") == "text"
+    )
+
+# Prefixo da execução atual (ex.: "TESTE 1"). Com várias execuções em concorrência, o eco dos tokens
+# passa a ser feito por linhas completas e prefixadas, para não se misturar carácter a carácter.
+_STREAM_PREFIX: contextvars.ContextVar[str | None] = contextvars.ContextVar("stream_prefix", default=None)
+
+class _StreamEcho:
+    """Eco dos tokens no stdout: direto sem prefixo, ou por linhas completas com o prefixo da execução."""
+
+    def __init__(self, prefix: str | None):
+        self._prefix = prefix
+        self._pending = ""
+
+    def write(self, text: str) -> None:
+        if self._prefix is None:
+            print(text, end="", flush=True)
+            return
+        *lines, self._pending = (self._pending + text).split("\n")
+        for line in lines:
+            print(f"[{self._prefix}] {line}", flush=True)
+
+    def close(self) -> None:
+        if self._prefix is None:
+            print()
+        elif self._pending:
+            print(f"[{self._prefix}] {self._pending}", flush=True)
+            self._pending = ""
+
+async def _astream_llm(llm_input_messages: List[BaseMessage]) -> AIMessage:
+    """Invoca o LLM em streaming, mostrando os tokens à medida que chegam, e devolve a AIMessage completa.
+    Usa o mesmo limitador e a mesma política de repetição que _ainvoke_guarded."""
+    echo = _StreamEcho(_STREAM_PREFIX.get())
+    async for attempt in _llm_retrying():
+        with attempt:
+            parts = []
+            async with _LLM_LIMITER:
+                try:
+                    async for chunk in llm.astream(llm_input_messages):
+                        text = _chunk_text(chunk)
+                        if text:
+                            parts.append(text)
+                            echo.write(text)
+                except anthropic.RateLimitError:
+                    _LLM_LIMITER.on_rate_limit()
+                    raise
+                _LLM_LIMITER.on_success()
+    echo.close()
+    return AIMessage(content="".join(parts))
+
+# --- COMPACTAÇÃO DO HISTÓRICO ---
+
+# Resumos já gerados, indexados pelo hash da fatia do histórico resumida
+_SUMMARY_CACHE: LRUCache = LRUCache(maxsize=128)
+
+def _approx_num_tokens(messages: Sequence[BaseMessage]) -> int:
+    """Estimativa local (~4 caracteres por token). A contagem exata do ChatAnthropic é um pedido HTTP
+    (count_tokens) fora do limitador e do tratamento de 429 — demasiado caro para cada nó."""
+    return sum(len(str(m.content)) for m in messages) // 4
+
+async def _compact_history(messages: Sequence[BaseMessage], max_tokens: int = 4000, keep_last: int = 6) -> List[BaseMessage]:
+    """Limita o histórico enviado ao LLM: mantém a primeira mensagem (pedido inicial ou system prompt),
+    as últimas `keep_last` mensagens e substitui o meio por um resumo (gerado uma vez e memoizado)."""
+    if len(messages) <= keep_last + 1:
+        return list(messages)
+    if _approx_num_tokens(messages) <= max_tokens:
+        return list(messages)
+
+    # Não separar ToolMessages da AIMessage com as tool_calls correspondentes
+    split = len(messages) - keep_last
+    while split > 1 and isinstance(messages[split], ToolMessage):
+        split -= 1
+    head, middle, tail = list(messages[:1]), list(messages[1:split]), list(messages[split:])
+    if not middle:
+        return list(messages)
+
+    transcript = "\n".join(f"{m.type}: {m.content}" for m in middle)
+    key = hashlib.sha1(transcript.encode()).hexdigest()
+    summary = _SUMMARY_CACHE.get(key)
+    if summary is None:
+        print(f"--- [HISTORY] A resumir {len(middle)} mensagens intermédias do histórico ---")
+        response = await _ainvoke_guarded(llm, [
+            SystemMessage(content="Resume de forma concisa a conversa seguinte, preservando factos, resultados de ferramentas e decisões tomadas."),
+            HumanMessage(content=transcript),
+        ])
+        summary = AIMessage(content=f"Resumo da conversa anterior: {response.content}")
+        _SUMMARY_CACHE[key] = summary
+    return [*head, summary, *tail]
+
+def _detect_tool_error_loop(messages: Sequence[BaseMessage], k: int = 3) -> bool:
+    """Deteta um ciclo de erros: as últimas `k` ToolMessages são erros estruturados com o mesmo código e mensagem."""
+    last_errors = [_parse_tool_error(m.content) for m in messages if isinstance(m, ToolMessage)][-k:]
+    return (
+        len(last_errors) == k
+        and all(last_errors)
+        and len({(error["code"], _tool_error_text(error)) for error in last_errors}) == 1
+    )
 
 # --- LÓGICA DOS NÓS (Integrando LLM) ---
 
+# Tabela de tradução para remover acentos comuns (construída uma única vez)
+_ACCENT_TBL = str.maketrans({
+    'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a',
+    'é': 'e', 'ê': 'e',
+    'í': 'i',
+    'ó': 'o', 'ô': 'o', 'õ': 'o',
+    'ú': 'u', 'ü': 'u',
+    'ç': 'c'
+})
+
 # Função auxiliar para normalização de texto simples
 def normalize_text(text: str) -> str:
     """Converte para minúsculas e remove acentos comuns."""
-    text = text.lower()
-    replacements = {
-        'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a',
-        'é': 'e', 'ê': 'e',
-        'í': 'i',
-        'ó': 'o', 'ô': 'o', 'õ': 'o',
-        'ú': 'u', 'ü': 'u',
-        'ç': 'c'
-    }
-    for accented, unaccented in replacements.items():
-        text = text.replace(accented, unaccented)
-    return text
-
-# Recuperador Mock (BigTool Simulado) - COM NORMALIZAÇÃO
-def simplified_retrieve_tools(query: str, available_tool_names: List[str]) -> List[str]:
-    print(f"\n--- [MOCK BIGTOOL] Retrieving tools for query: '{query}' ---")
-    print(f"--- [MOCK BIGTOOL] Available MCP tool names: {available_tool_names} ---")
-    normalized_query = normalize_text(query) # Normalizar query
+    return text.lower().translate(_ACCENT_TBL)
+
+# Dicionário de palavras-chave para ferramentas (estático)
+KEYWORD_MAP = {
+    "tempo": "get_weather", "weather": "get_weather", "clima": "get_weather",
+    "soma": "add", "add": "add", "+": "add", "matematica": "add",
+    "multiplica": "multiply", "*": "multiply",
+    "tabela": "list_tables", "listar tabelas": "list_tables", "tables": "list_tables",
+    "colunas": "describe_table", "descrever": "describe_table", "schema": "describe_table",
+    "ler": "read_query", "le": "read_query", # Adicionado 'le' para capturar 'lê'
+    "select": "read_query", "consultar": "read_query", "query": "read_query",
+    "escrever": "write_query", "inserir": "write_query", "atualizar": "write_query", "apagar": "write_query",
+    "insert": "write_query", "update": "write_query", "delete": "write_query",
+    "base de dados": "list_tables", "database": "list_tables", "db": "list_tables", "sqlite":"list_tables"
+}
+
+# Normalizar todas as chaves do dicionário (uma vez, no import)
+_NORMALIZED_KEYWORD_MAP = {normalize_text(k): v for k, v in KEYWORD_MAP.items()}
+
+# Autómato Aho-Corasick sobre as keywords normalizadas: uma única passagem
+# linear pela query encontra todas as correspondências
+_AC = ahocorasick.Automaton()
+for _keyword, _tool_name in _NORMALIZED_KEYWORD_MAP.items():
+    _AC.add_word(_keyword, (len(_keyword), _tool_name))
+_AC.make_automaton()
+
+# Núcleo da recuperação, memoizado pela query normalizada e pelo conjunto de ferramentas
+@functools.lru_cache(maxsize=512)
+def _retrieve_tools_cached(normalized_query: str, available: tuple[str, ...]) -> tuple[str, ...]:
     relevant_names = []
-    # Dicionário de palavras-chave para ferramentas
-    keyword_map = {
-        "tempo": "get_weather", "weather": "get_weather", "clima": "get_weather",
-        "soma": "add", "add": "add", "+": "add", "matematica": "add",
-        "multiplica": "multiply", "*": "multiply",
-        "tabela": "list_tables", "listar tabelas": "list_tables", "tables": "list_tables",
-        "colunas": "describe_table", "descrever": "describe_table", "schema": "describe_table",
-        "ler": "read_query", "le": "read_query", # Adicionado 'le' para capturar 'lê'
-        "select": "read_query", "consultar": "read_query", "query": "read_query",
-        "escrever": "write_query", "inserir": "write_query", "atualizar": "write_query", "apagar": "write_query",
-        "insert": "write_query", "update": "write_query", "delete": "write_query",
-        "base de dados": "list_tables", "database": "list_tables", "db": "list_tables", "sqlite":"list_tables"
-    }
-    
-    # Normalizar todas as chaves do dicionário
-    normalized_keyword_map = {normalize_text(k): v for k, v in keyword_map.items()}
-    
-    # Ordenar keywords por comprimento descendente para evitar correspondências parciais
-    sorted_keywords = sorted(normalized_keyword_map.keys(), key=len, reverse=True)
-
-    # Encontrar correspondências de palavras-chave na query normalizada
-    for keyword in sorted_keywords:
-        if keyword in normalized_query:
-            tool_name = normalized_keyword_map[keyword]
-            if tool_name in available_tool_names and tool_name not in relevant_names:
-                relevant_names.append(tool_name)
+
+    # Encontrar correspondências de palavras-chave na query normalizada.
+    # Todas as correspondências (iter); só se descartam as contidas numa correspondência mais longa
+    # (ex.: "le" dentro de "tabela"). iter_long não serve: perde "tabela" em "listar tabela".
+    matches = sorted(
+        (end - length + 1, -end, tool_name) for end, (length, tool_name) in _AC.iter(normalized_query)
+    )
+    max_end = -1
+    for _, neg_end, tool_name in matches:
+        # Ordenadas por início e, no mesmo início, a mais longa primeiro: contida se acaba antes de uma anterior
+        if -neg_end <= max_end:
+            continue
+        max_end = -neg_end
+        if tool_name in available and tool_name not in relevant_names:
+            relevant_names.append(tool_name)
     
     # Lógica adicional para read_query (mantida)
     if "read_query" in relevant_names:
-         if "describe_table" in available_tool_names and "describe_table" not in relevant_names:
+         if "describe_table" in available and "describe_table" not in relevant_names:
              relevant_names.append("describe_table")
-         if "list_tables" in available_tool_names and "list_tables" not in relevant_names:
+         if "list_tables" in available and "list_tables" not in relevant_names:
              relevant_names.append("list_tables")
+
+    return tuple(relevant_names)
+
+# Recuperador Mock (BigTool Simulado) - COM NORMALIZAÇÃO
+def simplified_retrieve_tools(query: str, available_tool_names: List[str]) -> List[str]:
+    print(f"\n--- [MOCK BIGTOOL] Retrieving tools for query: '{query}' ---")
+    print(f"--- [MOCK BIGTOOL] Available MCP tool names: {available_tool_names} ---")
+    normalized_query = normalize_text(query) # Normalizar query
+    relevant_names = list(_retrieve_tools_cached(normalized_query, tuple(sorted(available_tool_names))))
     
     print(f"--- [MOCK BIGTOOL] Normalized query: '{normalized_query}' ---")
     print(f"--- [MOCK BIGTOOL] Found relevant tool names: {relevant_names} ---")
     return relevant_names
 
+# Palavras-chave que indicam uma tarefa complexa (CodeAct)
+_COMPLEX_KEYWORDS = ["calcular", "processar", "combinar", "código", "code", " e ", "sql"] # Adicionado 'sql', 'e'
+# Uma única regex sobre as keywords. Sem remover acentos: " e " não deve corresponder a "é"
+_COMPLEX_RE = re.compile('|'.join(map(re.escape, _COMPLEX_KEYWORDS)))
+
+# Intenções comuns reconhecidas por uma única regex compilada (grupo nomeado -> agente).
+# Uma só intenção decide a rota; várias intenções indicam uma tarefa multi-ferramenta (CodeAct).
+INTENT_RE = re.compile(
+    r"\b(?:(?P<weather>tempo|weather|clima|chuva|temperatura)"
+    r"|(?P<math>soma|somar|calcula|multiplica)"
+    r"|(?P<sql>tabelas?|sqlite|select))\b"
+)
+_INTENT_ROUTES = {"weather": "react_agent", "math": "codeact_agent", "sql": "react_agent"}
+
+def _match_intents(task_desc: str) -> set[str]:
+    return {match.lastgroup for match in INTENT_RE.finditer(task_desc)}
+
+# Decisões de roteamento já tomadas, por (digest da tarefa, várias ferramentas recuperadas?)
+_ROUTE_CACHE: LRUCache = LRUCache(maxsize=1024)
+_ROUTE_CACHE_LOCK = threading.Lock() # O LangGraph pode chamar o roteador síncrono a partir de threads
+
 # Roteador (Síncrono) - Mantém-se como antes por simplicidade, mas podia usar LLM
 def route_to_agent(state: AgentState) -> Literal["react_agent", "codeact_agent"]:
     # ... (código como antes) ...
@@ -114,131 +679,301 @@ def route_to_agent(state: AgentState) -> Literal["react_agent", "codeact_agent"]
     task_desc = state.get("task_description", "").lower()
     retrieved_tools = state.get("retrieved_tool_names", [])
     print(f"Supervisor analyzing task: '{task_desc}', Tools: {retrieved_tools}")
-    complex_keywords = ["calcular", "processar", "combinar", "código", "code", " e ", "sql"] # Adicionado 'sql', 'e'
-    if any(keyword in task_desc for keyword in complex_keywords) or len(retrieved_tools or []) > 1:
-        print("Supervisor decided: Route to codeact_agent")
-        return "codeact_agent"
+    route_key = (hashlib.blake2b(task_desc.encode(), digest_size=16).hexdigest(), len(retrieved_tools or []) > 1)
+    with _ROUTE_CACHE_LOCK:
+        route = _ROUTE_CACHE.get(route_key)
+    if route is not None:
+        print(f"Supervisor decided (cache): Route to {route}")
+        return route
+
+    intents = _match_intents(task_desc)
+    if len(intents) == 1 and len(retrieved_tools or []) <= 1:
+        route = _INTENT_ROUTES[intents.pop()]
+    elif intents:
+        route = "codeact_agent"
+    # Sem intenção reconhecida: heurística por palavras-chave e número de ferramentas
+    elif _COMPLEX_RE.search(task_desc) or len(retrieved_tools or []) > 1:
+        route = "codeact_agent"
     else:
-        print("Supervisor decided: Route to react_agent")
-        return "react_agent"
+        route = "react_agent"
+    with _ROUTE_CACHE_LOCK:
+        _ROUTE_CACHE[route_key] = route
+    print(f"Supervisor decided: Route to {route}")
+    return route
+
+# Geração dos argumentos ReAct para uma ferramenta (partilhada pelo supervisor e pelo react_agent)
+async def _generate_tool_call(tool: BaseTool, messages: Sequence[BaseMessage]) -> AIMessage:
+    # ---- Formatar schema para o prompt (memoizado por ferramenta) ----
+    _, schema_str = _tool_prompt_parts(tool)
+
+    # Lista de mensagens construída manualmente (sem template, não é preciso escapar chavetas)
+    llm_input_messages = [
+        _cached_system_message(f"És um assistente prestável. A tua tarefa é usar a ferramenta '{tool.name}' para responder ao pedido do utilizador. "
+                               f"Descrição da ferramenta: {tool.description}. Schema de argumentos JSON: {schema_str}. "
+                               f"Analisa a conversa e invoca a ferramenta com os argumentos corretos."),
+        *await _compact_history(messages)
+    ]
+    return await _ainvoke_guarded(_llm_with_tool(_register_tool(tool), tool.name), llm_input_messages)
+
+# Limite de gerações especulativas em curso (evita gastar tokens se o roteamento mudar com frequência)
+_SPECULATION_SEM = asyncio.Semaphore(2)
+
+async def _speculative_tool_call(tool: BaseTool, messages: Sequence[BaseMessage]) -> AIMessage:
+    async with _SPECULATION_SEM:
+        return await _generate_tool_call(tool, messages)
+
+# Gerações especulativas em curso, por execução do grafo (config["configurable"]["run_id"]).
+# Tarefas asyncio não pertencem ao estado: não são serializáveis nem podem ir para um checkpoint.
+_SPECULATIVE_CALLS: Dict[str, tuple[str, asyncio.Task]] = {}
+
+def _pop_speculative_call(config: RunnableConfig | None) -> tuple[str, asyncio.Task] | None:
+    run_id = _configurable(config).get("run_id")
+    return _SPECULATIVE_CALLS.pop(run_id, None) if run_id else None
+
+def _discard_speculative_call(config: RunnableConfig | None) -> None:
+    speculative_tool_call = _pop_speculative_call(config)
+    if speculative_tool_call:
+        speculative_tool_call[1].cancel()
 
 # Nó Supervisor (Async) - Como antes
-async def supervisor(state: AgentState) -> dict:
+async def supervisor(state: AgentState, config: RunnableConfig) -> dict:
     # ... (código como antes) ...
     print("\n--- [NODE] Executing supervisor ---")
     last_message = state["messages"][-1]
     task_desc = last_message.content
-    mcp_tools = state.get("mcp_tools", {})
-    available_tool_names = list(mcp_tools.keys()) if mcp_tools else []
+    mcp_client = _configurable(config).get("mcp_client")
+    mcp_tools = _configurable(config).get("mcp_tools") or {}
+    if mcp_client:
+        available_tool_names = [tool.name for tool in await mcp_client.list_tools()]
+    else:
+        available_tool_names = list(mcp_tools.keys())
     print(f"Supervisor received task: '{task_desc}'")
     retrieved_tool_names = simplified_retrieve_tools(task_desc, available_tool_names)
+
+    # Com uma única ferramenta, o caminho provável é o ReAct: começar já a gerar os argumentos
+    # em paralelo com o roteamento. O codeact_agent cancela a tarefa se for escolhido.
+    run_id = _configurable(config).get("run_id")
+    if run_id and len(retrieved_tool_names) == 1 and retrieved_tool_names[0] in mcp_tools and llm and not _SPECULATION_SEM.locked():
+        tool = mcp_tools[retrieved_tool_names[0]]
+        print(f"Supervisor: A gerar especulativamente os argumentos para {tool.name}...")
+        task = asyncio.create_task(_speculative_tool_call(tool, state["messages"]))
+        # Recolher a exceção de uma tarefa descartada (evita "exception was never retrieved")
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        _discard_speculative_call(config)
+        _SPECULATIVE_CALLS[run_id] = (tool.name, task)
+
     return {
         "task_description": task_desc,
-        "retrieved_tool_names": retrieved_tool_names
+        "retrieved_tool_names": retrieved_tool_names,
     }
 
 # Nó ReAct (Async) - CORREÇÃO na formatação do schema
-async def react_agent(state: AgentState) -> dict:
+async def react_agent(state: AgentState, config: RunnableConfig) -> dict:
+    # A geração especulativa do supervisor é usada no máximo uma vez; em qualquer outro caminho
+    # (saídas antecipadas, outra ferramenta, erros) é cancelada. cancel() não afeta uma tarefa já concluída.
+    speculative_tool_call = _pop_speculative_call(config)
+    try:
+        return await _react_agent_step(state, config, speculative_tool_call)
+    finally:
+        if speculative_tool_call:
+            speculative_tool_call[1].cancel()
+
+async def _react_agent_step(state: AgentState, config: RunnableConfig, speculative_tool_call: tuple[str, asyncio.Task] | None) -> dict:
     print("\n--- [NODE] Executing react_agent ---")
     task_desc = state["task_description"]
     tool_names = state.get("retrieved_tool_names", [])
-    messages = list(state["messages"])
-    mcp_tools = state.get("mcp_tools", {})
+    messages = state["messages"] # Histórico completo (só leitura)
+    new_messages = [] # Apenas as mensagens produzidas por este nó (o reducer junta-as ao histórico)
+    mcp_client = _configurable(config).get("mcp_client")
+    mcp_tools = _configurable(config).get("mcp_tools") or {}
     agent_outcome = "Não foi possível executar a ação ReAct."
 
     if not mcp_tools or not llm:
-         agent_outcome = "Erro fatal: Ferramentas MCP ou LLM não disponíveis no estado."
-         messages.append(AIMessage(content=agent_outcome))
-         return {"messages": messages, "agent_outcome": agent_outcome}
+         agent_outcome = "Erro fatal: Ferramentas MCP ou LLM não disponíveis na configuração."
+         new_messages.append(AIMessage(content=agent_outcome))
+         return {"messages": new_messages, "agent_outcome": agent_outcome}
+
+    if _detect_tool_error_loop(messages):
+         agent_outcome = "Abortado: as últimas chamadas de ferramentas falharam repetidamente com o mesmo erro."
+         print(f"React Agent: {agent_outcome}")
+         new_messages.append(AIMessage(content=agent_outcome))
+         return {"messages": new_messages, "agent_outcome": agent_outcome}
 
     if tool_names:
         tool_name_to_call = tool_names[0]
         if tool_name_to_call not in mcp_tools:
             agent_outcome = f"Erro: Ferramenta recuperada '{tool_name_to_call}' não encontrada."
-            messages.append(AIMessage(content=agent_outcome))
-            return {"messages": messages, "agent_outcome": agent_outcome}
+            new_messages.append(AIMessage(content=agent_outcome))
+            return {"messages": new_messages, "agent_outcome": agent_outcome}
 
         tool_to_call: BaseTool = mcp_tools[tool_name_to_call]
         print(f"React Agent will use tool: {tool_to_call.name} - {tool_to_call.description}")
 
-        # ---- CORREÇÃO: Formatar schema para o prompt + ESCAPAR CHAVES ----
-        raw_schema_str = 'Nenhum argumento necessário'
-        if tool_to_call.args_schema:
-            # Se for um dict (schema JSON), converter para string JSON
-            if isinstance(tool_to_call.args_schema, dict):
-                try:
-                    raw_schema_str = json.dumps(tool_to_call.args_schema)
-                except TypeError:
-                    raw_schema_str = str(tool_to_call.args_schema) # Fallback
-            # Se tiver o método schema_json (Pydantic), usar (compatibilidade futura)
-            elif hasattr(tool_to_call.args_schema, 'schema_json'):
-                 raw_schema_str = tool_to_call.args_schema.schema_json()
-            # Senão, usar representação string
-            else:
-                 raw_schema_str = str(tool_to_call.args_schema)
-
-        # Escapar chaves para o formatador de prompt
-        schema_str = raw_schema_str.replace('{', '{{').replace('}', '}}')
-
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", f"És um assistente prestável. A tua tarefa é usar a ferramenta '{tool_to_call.name}' para responder ao pedido do utilizador. "
-                       f"Descrição da ferramenta: {tool_to_call.description}. Schema de argumentos JSON: {schema_str}. " # Schema escapado aqui
-                       f"Analisa a conversa e invoca a ferramenta com os argumentos corretos."),
-            *messages
-        ])
-        # ----------------------------------------------
-
-        llm_with_specific_tool = llm.bind_tools([tool_to_call], tool_choice=tool_to_call.name)
-        print(f"React Agent: Chamando LLM para obter args para {tool_to_call.name}...")
-
         try:
-            # Agora deve formatar corretamente
-            ai_message_with_tool_call = await llm_with_specific_tool.ainvoke(prompt.format_messages())
-            messages.append(ai_message_with_tool_call)
+            if speculative_tool_call and speculative_tool_call[0] == tool_to_call.name:
+                print(f"React Agent: A usar args gerados especulativamente pelo supervisor para {tool_to_call.name}...")
+                ai_message_with_tool_call = await speculative_tool_call[1]
+            else:
+                print(f"React Agent: Chamando LLM para obter args para {tool_to_call.name}...")
+                ai_message_with_tool_call = await _generate_tool_call(tool_to_call, messages)
+            new_messages.append(ai_message_with_tool_call)
 
             if not ai_message_with_tool_call.tool_calls:
                 print("React Agent: LLM não gerou uma chamada de ferramenta.")
                 agent_outcome = ai_message_with_tool_call.content
-                return {"messages": messages, "agent_outcome": agent_outcome}
+                return {"messages": new_messages, "agent_outcome": agent_outcome}
 
-            tool_call_info = ai_message_with_tool_call.tool_calls[0]
-            args = tool_call_info.get('args', {})
-            call_id = tool_call_info.get('id', tool_name_to_call)
+            tool_calls = ai_message_with_tool_call.tool_calls
+            for tool_call_info in tool_calls:
+                print(f"React Agent: LLM gerou chamada para {tool_call_info['name']} com args: {tool_call_info.get('args', {})}")
 
-            print(f"React Agent: LLM gerou chamada para {tool_name_to_call} com args: {args}")
+            # Chamadas independentes executadas em concorrência (gather preserva a ordem)
+            tool_results = await asyncio.gather(
+                *(tool_run_cache.get_or_call(mcp_tools.get(tc['name'], tool_to_call), tc.get('args', {}), mcp_client) for tc in tool_calls),
+                return_exceptions=True
+            )
 
-            try:
-                tool_result = await tool_to_call.ainvoke(args)
-                agent_outcome = str(tool_result)
-                messages.append(ToolMessage(content=agent_outcome, tool_call_id=call_id))
-            except Exception as e:
-                agent_outcome = f"Erro ao invocar a ferramenta MCP {tool_to_call.name} com args {args}: {e}"
-                messages.append(ToolMessage(content=agent_outcome, tool_call_id=call_id))
-                import traceback; print(traceback.format_exc())
+            outcomes = []
+            for tool_call_info, tool_result in zip(tool_calls, tool_results):
+                args = tool_call_info.get('args', {})
+                call_id = tool_call_info.get('id', tool_call_info['name'])
+                if isinstance(tool_result, Exception):
+                    outcome = _invocation_error(f"Erro ao invocar a ferramenta MCP {tool_call_info['name']} com args {args}: {tool_result}")
+                    import traceback; print("".join(traceback.format_exception(type(tool_result), tool_result, tool_result.__traceback__)))
+                else:
+                    outcome = str(tool_result)
+                new_messages.append(ToolMessage(content=outcome, tool_call_id=call_id))
+                outcomes.append(outcome)
+            agent_outcome = "\n".join(outcomes)
 
         except Exception as e:
              agent_outcome = f"Erro ao chamar LLM para obter argumentos para {tool_to_call.name}: {e}"
-             messages.append(AIMessage(content=agent_outcome))
+             new_messages.append(AIMessage(content=agent_outcome))
              import traceback; print(traceback.format_exc()) # Imprimir traceback completo
 
     else:
         print("React Agent: Nenhuma ferramenta relevante encontrada pelo BigTool mock.")
         try:
-             prompt = ChatPromptTemplate.from_messages([
-                 ("system", "És um assistente prestável. Responde diretamente ao utilizador."),
-                 *messages
-             ])
-             direct_response = await llm.ainvoke(prompt.format_messages())
+             llm_input_messages = [
+                 SystemMessage(content="És um assistente prestável. Responde diretamente ao utilizador."),
+                 *await _compact_history(messages)
+             ]
+             direct_response = await _ainvoke_guarded(llm, llm_input_messages)
              agent_outcome = direct_response.content
-             messages.append(direct_response)
+             new_messages.append(direct_response)
         except Exception as e:
             agent_outcome = f"Erro ao tentar obter resposta direta do LLM: {e}"
-            messages.append(AIMessage(content=agent_outcome))
+            new_messages.append(AIMessage(content=agent_outcome))
 
 
     print(f"React Agent final outcome: {agent_outcome}")
-    return {"messages": messages, "agent_outcome": agent_outcome}
-
+    return {"messages": new_messages, "agent_outcome": agent_outcome}
+
+
+# --- AGRUPAMENTO DE CHAMADAS INDEPENDENTES NO CÓDIGO GERADO ---
+# Nós permitidos nos argumentos de uma chamada agrupável: literais e nomes simples.
+# Qualquer outra expressão (chamadas, atributos, índices...) pode ler estado que as awaits anteriores alteram.
+_SIMPLE_ARG_NODES = (
+    ast.Constant, ast.Name, ast.Load, ast.Dict, ast.List, ast.Tuple, ast.Set,
+    ast.Starred, ast.UnaryOp, ast.USub, ast.UAdd,
+)
+
+def _is_simple_arg(node: ast.expr) -> bool:
+    return all(isinstance(child, _SIMPLE_ARG_NODES) for child in ast.walk(node))
+
+def _tool_await_assign(stmt: ast.stmt) -> tuple[str, ast.Call, set[str]] | None:
+    """Reconhece `x = await ferramenta.ainvoke(...)`; devolve (alvo, chamada, nomes referenciados)."""
+    if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)):
+        return None
+    value = stmt.value
+    if not (isinstance(value, ast.Await) and isinstance(value.value, ast.Call)):
+        return None
+    call = value.value
+    func = call.func
+    if not (isinstance(func, ast.Attribute) and func.attr == "ainvoke" and isinstance(func.value, ast.Name)):
+        return None
+    # Escritas mantêm a ordem original (uma leitura seguinte pode depender delas)
+    if func.value.id in _NON_IDEMPOTENT_TOOLS:
+        return None
+    if not all(_is_simple_arg(arg) for arg in [*call.args, *(kw.value for kw in call.keywords)]):
+        return None
+    referenced = {node.id for node in ast.walk(call) if isinstance(node, ast.Name)}
+    return stmt.targets[0].id, call, referenced
+
+def _gather_assign(group: list[tuple[ast.stmt, str, ast.Call]]) -> ast.stmt:
+    targets = ast.Tuple(elts=[ast.Name(id=target, ctx=ast.Store()) for _, target, _ in group], ctx=ast.Store())
+    gather = ast.Attribute(value=ast.Name(id="asyncio", ctx=ast.Load()), attr="gather", ctx=ast.Load())
+    value = ast.Await(value=ast.Call(func=gather, args=[call for _, _, call in group], keywords=[]))
+    return ast.copy_location(ast.Assign(targets=[targets], value=value), group[0][0])
+
+def _batch_stmt_list(stmts: list[ast.stmt]) -> tuple[list[ast.stmt], int]:
+    batched: list[ast.stmt] = []
+    group: list[tuple[ast.stmt, str, ast.Call]] = []
+    assigned: set[str] = set()
+    merged = 0
+
+    def flush() -> None:
+        nonlocal merged
+        if len(group) > 1:
+            batched.append(_gather_assign(group))
+            merged += 1
+        else:
+            batched.extend(stmt for stmt, _, _ in group)
+        group.clear()
+        assigned.clear()
+
+    for stmt in stmts:
+        match = _tool_await_assign(stmt)
+        if match is None:
+            flush()
+            batched.append(stmt)
+            continue
+        target, call, referenced = match
+        # Dependência: os argumentos usam o resultado de uma chamada anterior do grupo
+        if referenced & assigned or target in assigned:
+            flush()
+        group.append((stmt, target, call))
+        assigned.add(target)
+    flush()
+    return batched, merged
+
+_TRY_NODES = (ast.Try, ast.TryStar) if hasattr(ast, "TryStar") else (ast.Try,)
+
+def _batch_independent_tool_calls(node: ast.AST, in_try: bool = False) -> int:
+    """Funde sequências de `await ferramenta.ainvoke(...)` independentes num único `asyncio.gather`.
+
+    Nada é agrupado dentro do corpo de um `try`: aí, uma exceção da primeira chamada tem de
+    impedir as seguintes, o que o gather não garante."""
+    merged = 0
+    for field in ("body", "orelse", "finalbody"):
+        stmts = getattr(node, field, None)
+        if not (isinstance(stmts, list) and stmts and isinstance(stmts[0], ast.stmt)):
+            continue
+        protected = in_try or (isinstance(node, _TRY_NODES) and field == "body")
+        if not protected:
+            stmts, count = _batch_stmt_list(stmts)
+            if count:
+                setattr(node, field, stmts)
+                merged += count
+        for stmt in stmts:
+            merged += _batch_independent_tool_calls(stmt, protected)
+    for handler in getattr(node, "handlers", []):
+        merged += _batch_independent_tool_calls(handler, in_try)
+    return merged
+
+# Compilação do código gerado memoizada pelo texto fonte (nome de ficheiro estável para tracebacks)
+@functools.lru_cache(maxsize=256)
+def _compile_code(code: str):
+    filename = f"<codeact-{hashlib.sha1(code.encode()).hexdigest()[:8]}>"
+    tree = ast.parse(code, filename, "exec")
+    merged = _batch_independent_tool_calls(tree)
+    if merged:
+        print(f"--- [UNSAFE EVAL] {merged} grupo(s) de chamadas independentes agrupados com asyncio.gather ---")
+        ast.fix_missing_locations(tree)
+    return compile(tree, filename, "exec")
+
+# Nomes de variáveis aceites como resultado final do código gerado (por ordem de preferência)
+_RESULT_VAR_NAMES = ("final_output", "resultado", "resultado_final", "resposta_final", "resposta")
 
 # Eval inseguro (Suporte a código sync e async) - AGORA ASYNC
 async def unsafe_eval_for_test(code: str, _locals: dict) -> tuple[str, dict]:
@@ -246,12 +981,15 @@ async def unsafe_eval_for_test(code: str, _locals: dict) -> tuple[str, dict]:
     Executa código Python potencialmente assíncrono em um ambiente de teste.
     AVISO: Esta função é APENAS para testes e não deve ser utilizada em produção.
 
+    O código comunica resultados através da lista pré-alocada `_out` (via `_out.append(valor)`)
+    e/ou da variável global `final_output`.
+
     Args:
         code: String contendo código Python a ser executado
         _locals: Dicionário com variáveis locais (incluindo ferramentas) a serem disponibilizadas para o código
 
     Returns:
-        Tuple contendo (output do stdout, novas variáveis criadas)
+        Tuple contendo (valores registados em `_out`, novas variáveis criadas)
     """
     print("\n!!! WARNING: Using unsafe eval for testing !!!")
     original_keys = set(_locals.keys())
@@ -261,6 +999,7 @@ async def unsafe_eval_for_test(code: str, _locals: dict) -> tuple[str, dict]:
     exec_namespace = {
         "__builtins__": builtins,
         "asyncio": asyncio,
+        "_out": [],
     }
     exec_namespace.update(_locals)
 
@@ -270,29 +1009,27 @@ async def unsafe_eval_for_test(code: str, _locals: dict) -> tuple[str, dict]:
     print(f"--- [UNSAFE EVAL] Executando {'código assíncrono' if is_async_code else 'código síncrono'}:\n---\n{code}\n---")
 
     try:
-        # Redireccionar stdout para capturar a saída
-        with contextlib.redirect_stdout(io.StringIO()) as f:
-            if is_async_code:
-                # Executar o código para definir funções e variáveis no namespace
-                exec(code, exec_namespace)
-
-                # Verificar se main() existe e é assíncrona
-                main_func = exec_namespace.get("main")
-                if main_func and asyncio.iscoroutinefunction(main_func):
-                    # ---- CORREÇÃO: Chamar await diretamente ----
-                    print("--- [UNSAFE EVAL] Awaiting generated main() coroutine...")
-                    await main_func()
-                    # -----------------------------------------
-                else:
-                     print("--- [UNSAFE EVAL] Warning: Código async detectado, mas função 'async def main()' não encontrada ou não é corrotina.")
+        if is_async_code:
+            # Executar o código para definir funções e variáveis no namespace
+            exec(_compile_code(code), exec_namespace)
+
+            # Verificar se main() existe e é assíncrona
+            main_func = exec_namespace.get("main")
+            if main_func and asyncio.iscoroutinefunction(main_func):
+                # ---- CORREÇÃO: Chamar await diretamente ----
+                print("--- [UNSAFE EVAL] Awaiting generated main() coroutine...")
+                await main_func()
+                # -----------------------------------------
             else:
-                # Execução síncrona
-                exec(code, exec_namespace)
+                 print("--- [UNSAFE EVAL] Warning: Código async detectado, mas função 'async def main()' não encontrada ou não é corrotina.")
+        else:
+            # Execução síncrona
+            exec(_compile_code(code), exec_namespace)
 
-        # Capturar stdout
-        result_str = f.getvalue().strip()
+        # Recolher os valores registados em _out
+        result_str = "\n".join(str(value) for value in exec_namespace["_out"]).strip()
         if not result_str:
-            result_str = f"<{'código assíncrono' if is_async_code else 'código síncrono'} executado, sem output no stdout>"
+            result_str = f"<{'código assíncrono' if is_async_code else 'código síncrono'} executado, sem valores em _out>"
 
     except Exception as e:
         result_str = f"Erro durante a execução: {repr(e)}"
@@ -303,35 +1040,54 @@ async def unsafe_eval_for_test(code: str, _locals: dict) -> tuple[str, dict]:
                 if k not in ['__builtins__', 'asyncio'] and k not in original_keys
                 and not k.startswith('_')}
 
-    # Procurar por 'final_output' no namespace modificado
-    if "final_output" in exec_namespace:
-         # Atualizar new_vars se final_output foi modificado ou criado
-         new_vars["final_output"] = exec_namespace["final_output"]
-    elif "final_output" not in new_vars:
-         # Procurar outros nomes se 'final_output' não foi definido explicitamente
-         for result_var in ["resultado", "resultado_final", "resposta_final", "resposta"]:
-             if result_var in exec_namespace and exec_namespace[result_var] is not None:
-                 new_vars["final_output"] = exec_namespace[result_var]
-                 break
-
-    print(f"--- [UNSAFE EVAL] Result stdout: '{result_str}' ---")
+    # Procurar 'final_output' (ou nomes alternativos) no namespace modificado
+    final_output = next((exec_namespace[k] for k in _RESULT_VAR_NAMES if exec_namespace.get(k) is not None), None)
+    if final_output is not None or "final_output" in exec_namespace:
+         new_vars["final_output"] = final_output
+
+    print(f"--- [UNSAFE EVAL] Result _out: '{result_str}' ---")
     print(f"--- [UNSAFE EVAL] New/Updated variables (repr): {{k: repr(v) for k, v in new_vars.items()}} ---")
     return result_str, new_vars
 
 
+# Blocos de código markdown na resposta do LLM: a cerca de abertura tem de estar no início de uma linha
+# (uma cerca de fecho seguida de texto não abre um bloco novo); grupo 1 = linguagem, grupo 2 = código
+_CODE_BLOCK_RE = re.compile(r"^```(\w*)[ \t]*\n(.*?)```", re.DOTALL | re.MULTILINE)
+# Marcadores que indicam que um bloco ```python é código Python
+_CODE_HINTS = frozenset({'import ', 'async def ', 'def ', 'print(', '=', 'await'})
+# Heurística mais forte para um bloco ``` genérico
+_BARE_CODE_HINTS = frozenset({'async def main():', 'await', 'import'})
+
+def _extract_code(generated_content: str) -> str:
+    """Devolve o código do primeiro bloco ```python (ou, na falta dele, do primeiro bloco genérico
+    que pareça código Python); string vazia se nenhum bloco servir."""
+    blocks = [(m.group(1).lower(), m.group(2).strip()) for m in _CODE_BLOCK_RE.finditer(generated_content)]
+    for lang, code in blocks:
+        if lang == "python" and code and (any(kw in code for kw in _CODE_HINTS) or code.startswith('#')):
+            return code
+    for lang, code in blocks:
+        if not lang and any(kw in code for kw in _BARE_CODE_HINTS):
+            return code
+    return ""
+
 # Nó CodeAct (Async) - CORREÇÃO no prompt system
-async def codeact_agent(state: AgentState) -> dict:
+async def codeact_agent(state: AgentState, config: RunnableConfig) -> dict:
     print("\n--- [NODE] Executing codeact_agent ---")
     task_desc = state["task_description"]
     tool_names = state.get("retrieved_tool_names", [])
-    messages = list(state["messages"])
-    mcp_tools = state.get("mcp_tools", {})
+    messages = state["messages"] # Histórico completo (só leitura)
+    new_messages = [] # Apenas as mensagens produzidas por este nó (o reducer junta-as ao histórico)
+    mcp_client = _configurable(config).get("mcp_client")
+    mcp_tools = _configurable(config).get("mcp_tools") or {}
     agent_outcome = "Falha ao executar lógica CodeAct."
 
+    # O roteamento escolheu CodeAct: descartar a geração especulativa do supervisor
+    _discard_speculative_call(config)
+
     if not mcp_tools or not llm:
-         return {"messages": list(state["messages"]), "agent_outcome": "Erro fatal: Ferramentas MCP ou LLM não disponíveis."}
+         return {"messages": [], "agent_outcome": "Erro fatal: Ferramentas MCP ou LLM não disponíveis."}
     if not tool_names:
-         return {"messages": list(state["messages"]), "agent_outcome": "Nenhuma ferramenta relevante encontrada."}
+         return {"messages": [], "agent_outcome": "Nenhuma ferramenta relevante encontrada."}
 
     available_tools_for_eval = {}
     tool_descriptions_for_prompt = []
@@ -339,30 +1095,9 @@ async def codeact_agent(state: AgentState) -> dict:
     for tool_name in tool_names:
         if tool_name in mcp_tools:
              tool: BaseTool = mcp_tools[tool_name]
-             available_tools_for_eval[tool_name] = tool
-             # ---- CORREÇÃO: Formatar descrição dos args + ESCAPAR CHAVES ----
-             arg_keys_str = ''
-             if tool.args_schema:
-                 # Se for dict com 'properties', extrair as chaves
-                 if isinstance(tool.args_schema, dict) and 'properties' in tool.args_schema and isinstance(tool.args_schema['properties'], dict):
-                      arg_keys_str = ", ".join(tool.args_schema['properties'].keys())
-                 # Se for Pydantic model (v1 ou v2), tentar extrair de .schema()
-                 elif hasattr(tool.args_schema, 'schema') and callable(tool.args_schema.schema):
-                     try:
-                         schema_dict = tool.args_schema.schema()
-                         if isinstance(schema_dict, dict) and 'properties' in schema_dict and isinstance(schema_dict['properties'], dict):
-                              arg_keys_str = ", ".join(schema_dict['properties'].keys())
-                     except Exception: # Captura erros ao chamar .schema()
-                          pass # Mantém arg_keys_str vazio se falhar
-                 # Fallback para string se não for reconhecido
-                 if not arg_keys_str:
-                     arg_keys_str = str(tool.args_schema)
-
-             # Escapar chaves na string de argumentos e descrição para o formatador
-             escaped_arg_keys_str = arg_keys_str.replace('{', '{{').replace('}', '}}')
-             escaped_description = tool.description.replace('{', '{{').replace('}', '}}')
-
-             desc = f"- {tool.name}({escaped_arg_keys_str}): {escaped_description}"
+             available_tools_for_eval[tool_name] = _CachedToolProxy(tool, tool_run_cache, mcp_client)
+             arg_keys_str, _ = _tool_prompt_parts(tool)
+             desc = f"- {tool.name}({arg_keys_str}): {tool.description}"
              # ------------------------------------------
              tool_descriptions_for_prompt.append(desc)
              print(f"  - {tool_name}")
@@ -370,7 +1105,7 @@ async def codeact_agent(state: AgentState) -> dict:
             print(f"  - AVISO: Tool name '{tool_name}' recuperado mas não encontrado.")
 
     if not available_tools_for_eval:
-         return {"messages": list(state["messages"]), "agent_outcome": "Nenhuma ferramenta válida encontrada após recuperação."}
+         return {"messages": [], "agent_outcome": "Nenhuma ferramenta válida encontrada após recuperação."}
 
     # ---- CHAMADA LLM para gerar código Python ----
     tools_prompt_section = "\n".join(tool_descriptions_for_prompt)
@@ -382,9 +1117,10 @@ IMPORTANTE:
 1. O teu código deve estar contido numa função assíncrona `main()`.
 2. Todas as ferramentas são assíncronas. Deves chamá-las usando `await tool_name.ainvoke(arguments)`.
 3. O argumento `arguments` para `ainvoke` DEVE ser sempre um **DICIONÁRIO** Python contendo os parâmetros necessários para a ferramenta, mesmo que haja apenas um parâmetro.
-4. Usa `print()` para mostrar resultados intermédios se necessário.
+4. Regista resultados intermédios com `_out.append(valor)` (a lista `_out` já existe); NÃO uses `print()` para comunicar resultados.
 5. Define o resultado final numa variável global chamada `final_output`.
 6. NÃO precisas adicionar `import asyncio; asyncio.run(main())` no final.
+7. Quando as chamadas de ferramentas forem independentes entre si, executa-as em concorrência com `await asyncio.gather(...)` (o módulo `asyncio` já está disponível). O `gather` devolve os resultados pela mesma ordem das chamadas.
 
 Exemplo 1 (Ferramenta com um argumento):
 ```python
@@ -392,10 +1128,10 @@ async def main():
     global final_output
     try:
         resultado_weather = await get_weather.ainvoke({{"location": "Lisboa"}}) # Argumento como dicionário
-        print("Tempo:", resultado_weather)
+        _out.append(f"Tempo: {{resultado_weather}}")
         final_output = f"O tempo em Lisboa é: {{resultado_weather}}"
     except Exception as e:
-        print("Erro no Exemplo 1:", e)
+        _out.append(f"Erro no Exemplo 1: {{e}}")
         final_output = f"Erro ao obter tempo: {{e}}"
 ```
 
@@ -405,28 +1141,40 @@ async def main():
     global final_output
     try:
         resultado_soma = await add.ainvoke({{"a": 5, "b": 3}}) # Argumentos como dicionário
-        print("Soma:", resultado_soma)
+        _out.append(f"Soma: {{resultado_soma}}")
         final_output = f"A soma de 5 e 3 é: {{resultado_soma}}"
     except Exception as e:
-        print("Erro no Exemplo 2:", e)
+        _out.append(f"Erro no Exemplo 2: {{e}}")
         final_output = f"Erro ao somar: {{e}}"
+```
+
+Exemplo 3 (Ferramentas independentes em concorrência):
+```python
+async def main():
+    global final_output
+    try:
+        resultado_weather, resultado_soma = await asyncio.gather(
+            get_weather.ainvoke({{"location": "Porto"}}),
+            add.ainvoke({{"a": 10, "b": 5}}),
+        )
+        _out.append(f"Tempo: {{resultado_weather}} Soma: {{resultado_soma}}")
+        final_output = f"O tempo no Porto é: {{resultado_weather}}. A soma de 10 e 5 é: {{resultado_soma}}"
+    except Exception as e:
+        _out.append(f"Erro no Exemplo 3: {{e}}")
+        final_output = f"Erro ao executar as ferramentas: {{e}}"
 
 # Lembra-te: Sempre um dicionário para ainvoke!
 ```
 """
     # ------------------------------------------------------------
-    code_gen_prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        *messages # Histórico da conversa - Esta linha pode não ser necessária se construirmos manualmente abaixo
-    ])
     print("CodeAct Agent: Chamando LLM para gerar código...")
     try:
         # ---- CORREÇÃO: Construir lista de mensagens manualmente e invocar ----
         # Construir a lista de mensagens a enviar ao LLM
-        llm_input_messages = [SystemMessage(content=system_prompt)] + messages
+        llm_input_messages = [_cached_system_message(system_prompt), *await _compact_history(messages)]
 
-        # Passar a lista diretamente para ainvoke, em vez de format_messages()
-        code_gen_response = await llm.ainvoke(llm_input_messages)
+        # Passar a lista diretamente ao LLM (em streaming), em vez de format_messages()
+        code_gen_response = await _astream_llm(llm_input_messages)
         # ---------------------------------------------------------------------
 
         # O resto da lógica para processar a resposta continua igual...
@@ -434,32 +1182,18 @@ async def main():
         if hasattr(code_gen_response, 'content'):
              generated_content = code_gen_response.content
              # Adicionar a resposta do LLM ao histórico ANTES de processar/executar
-             # É importante manter o histórico completo
-             messages.append(code_gen_response)
+             new_messages.append(code_gen_response)
         else:
              # Fallback se a estrutura for diferente
              generated_content = str(code_gen_response)
              # Adicionar como AIMessage ao histórico
-             messages.append(AIMessage(content=generated_content))
+             new_messages.append(AIMessage(content=generated_content))
 
         print(f"CodeAct Agent: LLM gerou resposta:\n---\n{generated_content}\n---")
 
         # Extrair código Python do bloco de markdown, se existir
-        generated_code = "" # Inicializar vazio
-        is_code_block = False
-        if "```python" in generated_content:
-            potential_code = generated_content.split("```python")[1].split("```")[0].strip()
-            # Heurística para verificar se é código
-            if any(kw in potential_code for kw in ['import ', 'async def ', 'def ', 'print(', '=', 'await']) or potential_code.startswith('#'):
-                 generated_code = potential_code
-                 is_code_block = True
-        elif "```" in generated_content:
-             # Tentar extrair de um bloco genérico ```
-            potential_code = generated_content.split("```")[1].split("```")[0].strip()
-            # Heurística mais forte para bloco genérico
-            if 'async def main():' in potential_code or 'await' in potential_code or 'import' in potential_code:
-                 generated_code = potential_code
-                 is_code_block = True
+        generated_code = _extract_code(generated_content)
+        is_code_block = bool(generated_code)
 
 
         # Só tentar executar se for detetado código Python no generated_code extraído
@@ -473,15 +1207,15 @@ async def main():
             # Assumindo que unsafe_eval usa o dict passado como globals/locals
             # NOTA: A implementação atual de unsafe_eval_for_test já tenta encontrar 'final_output'
             # no namespace após a execução. Passar 'exec_globals' como _locals deve funcionar.
-            stdout_result, new_vars = await unsafe_eval_for_test(generated_code, exec_globals)
+            out_result, new_vars = await unsafe_eval_for_test(generated_code, exec_globals)
 
-            # Prioriza var 'final_output' capturada do escopo de execução, senão o stdout do print()
+            # Prioriza var 'final_output' capturada do escopo de execução, senão os valores de _out
             final_output_from_exec = new_vars.get('final_output') # Capturar de new_vars como unsafe_eval faz
 
             if final_output_from_exec is not None:
                  agent_outcome = final_output_from_exec
-            elif stdout_result:
-                 agent_outcome = stdout_result
+            elif out_result:
+                 agent_outcome = out_result
             else: # Se não houver nem var nem print
                  agent_outcome = "<Execução de código concluída sem output explícito>"
 
@@ -495,79 +1229,102 @@ async def main():
         agent_outcome = f"Erro durante a geração ou execução de código CodeAct: {e}"
         # Adicionar a mensagem de erro ao histórico ANTES de retornar
         # A resposta do LLM já foi adicionada, então só adicionamos uma mensagem de erro se ocorrer exceção DEPOIS
-        if not isinstance(messages[-1], AIMessage) or "Erro no CodeAct" not in messages[-1].content:
-             messages.append(AIMessage(content=f"Erro no CodeAct após resposta do LLM: {e}"))
+        if not new_messages or not isinstance(new_messages[-1], AIMessage) or "Erro no CodeAct" not in new_messages[-1].content:
+             new_messages.append(AIMessage(content=f"Erro no CodeAct após resposta do LLM: {e}"))
         import traceback; print(traceback.format_exc()) # Imprimir traceback completo
 
     print(f"CodeAct Agent final outcome: {agent_outcome}")
     # Garantir que as mensagens atualizadas (incluindo resposta do LLM e/ou erro) são retornadas
-    return {"messages": messages, "agent_outcome": agent_outcome}
+    return {"messages": new_messages, "agent_outcome": agent_outcome}
 
 
 # Nó Final (Async) - AGORA USA LLM PARA RESPOSTA FINAL
 async def final_answer(state: AgentState) -> dict:
     print("\n--- [NODE] Executing final_answer ---")
-    messages = list(state["messages"])
+    messages = state["messages"] # Histórico completo (só leitura)
+    new_messages = [] # Apenas as mensagens produzidas por este nó (o reducer junta-as ao histórico)
     final_outcome = state.get("agent_outcome", "Não foi possível determinar o resultado final.")
     print(f"Final Answer Node: Recebeu outcome: {final_outcome}")
 
+    # Erro estruturado não recuperável: não há dados para resumir, responder sem chamar o LLM
+    tool_error = _parse_tool_error(final_outcome)
+    if tool_error and tool_error.get("retryable") is False:
+        print(f"Final Answer: Erro não recuperável da ferramenta ({tool_error['code']}), não chamando LLM.")
+        new_messages.append(AIMessage(content=f"Não foi possível concluir o pedido: {_tool_error_text(tool_error)}"))
+        return {"messages": new_messages}
+
     # ---- CHAMADA LLM para gerar resposta final ----
     if not isinstance(messages[-1], AIMessage) or messages[-1].tool_calls:
          if llm:
              print("Final Answer: Chamando LLM para gerar resposta final...")
-             max_retries = 3
-             base_delay = 1.0
-             for attempt in range(max_retries):
-                 try:
-                     # ---- CORREÇÃO: Incorporar instrução no system prompt ----
-                     final_system_prompt = """És um assistente prestável e preciso. A tua tarefa é:
+             try:
+                 # ---- CORREÇÃO: Incorporar instrução no system prompt ----
+                 final_system_prompt = """És um assistente prestável e preciso. A tua tarefa é:
 1. Confiar completamente nos resultados das ferramentas externas utilizadas ou no código executado - considera esses dados como factos verificados e precisos.
 2. Resumir os resultados da interação de forma clara e direta.
 3. Responder à questão inicial do utilizador com base na informação recolhida.
 4. NUNCA sugerir que não tens informações ou que não podes responder quando os dados foram obtidos pelas ferramentas ou pelo código.
 5. Manter a resposta concisa e factual, baseada nos dados recebidos."""
-                     # ---------------------------------------------------------
-
-                     final_prompt = ChatPromptTemplate.from_messages([
-                         # Usar o prompt do sistema atualizado
-                         ("system", final_system_prompt),
-                         # Passar apenas as mensagens do histórico, sem adicionar SystemMessage extra
-                         *messages
-                     ])
-                     # Chamar LLM com o histórico correto
-                     final_response = await llm.ainvoke(final_prompt.format_messages()) # Passar mensagens formatadas pelo template
-                     messages.append(final_response)
-                     print(f"Final Answer: Resposta LLM: {final_response.content}")
-                     break
-                 except Exception as e:
-                     # Lógica de retry e tratamento de erro permanece a mesma
-                     if "ResourceExhausted" in str(e) or "429" in str(e) or "rate_limit_error" in str(e).lower(): # Adicionado check para Anthropic error type
-                         if attempt < max_retries - 1:
-                             delay = base_delay * (2 ** attempt)
-                             print(f"Rate limit atingido. Tentando novamente em {delay:.2f} segundos...")
-                             await asyncio.sleep(delay)
-                         else:
-                             print("Rate limit atingido. Máximo de tentativas excedido.")
-                             messages.append(AIMessage(content=f"Concluído, mas ocorreu um erro de limite de taxa ao formatar a resposta final. Resultado bruto: {final_outcome}"))
-                             break # Sair após erro final de rate limit
-                     elif "multiple non-consecutive system messages" in str(e): # Capturar erro específico do Claude
-                          print(f"Erro de formatação de mensagem do sistema: {e}")
-                          messages.append(AIMessage(content=f"Concluído, mas ocorreu um erro ao formatar a mensagem para o LLM. Resultado bruto: {final_outcome}"))
-                          # Adicionar mais debug se necessário: print(final_prompt.format_messages())
-                          break # Sair do loop de retries para este erro
-                     else:
-                         print(f"Erro não relacionado a rate limit ao gerar resposta final com LLM: {e}")
-                         messages.append(AIMessage(content=f"Concluído, mas ocorreu um erro inesperado ao formatar a resposta final. Resultado bruto: {final_outcome}"))
-                         import traceback; print(traceback.format_exc()) # Imprimir traceback para erros inesperados
-                         break
+                 # ---------------------------------------------------------
+
+                 llm_input_messages = [
+                     # Usar o prompt do sistema atualizado
+                     _cached_system_message(final_system_prompt),
+                     # Passar apenas as mensagens do histórico (compactado), sem adicionar SystemMessage extra
+                     *await _compact_history(messages)
+                 ]
+                 # Chamar LLM com o histórico correto (em streaming; _astream_llm repete em rate limits)
+                 final_response = await _astream_llm(llm_input_messages)
+                 new_messages.append(final_response)
+                 print(f"Final Answer: Resposta LLM: {final_response.content}")
+             except anthropic.RateLimitError:
+                 print("Rate limit atingido. Máximo de tentativas excedido.")
+                 new_messages.append(AIMessage(content=f"Concluído, mas ocorreu um erro de limite de taxa ao formatar a resposta final. Resultado bruto: {final_outcome}"))
+             except Exception as e:
+                 if "multiple non-consecutive system messages" in str(e): # Capturar erro específico do Claude
+                      print(f"Erro de formatação de mensagem do sistema: {e}")
+                      new_messages.append(AIMessage(content=f"Concluído, mas ocorreu um erro ao formatar a mensagem para o LLM. Resultado bruto: {final_outcome}"))
+                      # Adicionar mais debug se necessário: print(llm_input_messages)
+                 else:
+                     print(f"Erro não relacionado a rate limit ao gerar resposta final com LLM: {e}")
+                     new_messages.append(AIMessage(content=f"Concluído, mas ocorreu um erro inesperado ao formatar a resposta final. Resultado bruto: {final_outcome}"))
+                     import traceback; print(traceback.format_exc()) # Imprimir traceback para erros inesperados
          else:
-              messages.append(AIMessage(content=f"Concluído. Resultado: {final_outcome}"))
+              new_messages.append(AIMessage(content=f"Concluído. Resultado: {final_outcome}"))
     else:
          print("Final Answer: Última mensagem já é uma resposta AI, não chamando LLM.")
 
-    return {"messages": messages}
+    return {"messages": new_messages}
+
+# --- CONSTRUÇÃO DO GRAFO ---
+@functools.lru_cache(maxsize=1)
+def build_agent():
+    """Instancia e compila o agente LangGraph uma única vez por processo.
+    O grafo não depende do cliente MCP (ferramentas chegam via config), pelo que pode ser partilhado."""
+    agent_builder = CustomAgent(
+        state_schema=AgentState,
+        impl=[
+            ("supervisor", supervisor),
+            ("react_agent", react_agent),
+            ("codeact_agent", codeact_agent),
+            ("final_answer", final_answer),
+            ("conditional_edge_1", route_to_agent),
+        ],
+    )
+    return agent_builder.compile()
 
 # --- Função Principal Async ---
+async def _check_llm() -> bool:
+    """Verifica se o LLM está inicializado corretamente com o API_KEY do .env (e aquece a ligação TLS)."""
+    try:
+        # Teste simples do LLM para confirmar que a API key está funcionando
+        resposta_teste = await llm.ainvoke([HumanMessage(content="Olá, estás a funcionar?")])
+        print(f"LLM teste de conexão: {resposta_teste.content[:50]}...")
+        return True
+    except Exception as e:
+        print(f"ERRO CRÍTICO: Falha ao testar o LLM Anthropic. Verifique sua API key: {e}")
+        return False
+
 async def main():
     # Verificações e Configuração MCP
     if MultiServerMCPClient is None: 
@@ -578,14 +1335,9 @@ async def main():
         print("ERRO CRÍTICO: LLM Anthropic não configurado. Verifique sua chave API no .env.")
         return
     
-    # Verificar se LLM está inicializado corretamente com o API_KEY do .env
-    try:
-        # Teste simples do LLM para confirmar que a API key está funcionando
-        resposta_teste = await llm.ainvoke([HumanMessage(content="Olá, estás a funcionar?")])
-        print(f"LLM teste de conexão: {resposta_teste.content[:50]}...")
-    except Exception as e:
-        print(f"ERRO CRÍTICO: Falha ao testar o LLM Anthropic. Verifique sua API key: {e}")
-        return
+    # Teste do LLM em segundo plano: o handshake TLS/auth com a Anthropic decorre
+    # enquanto os servidores MCP arrancam; o resultado é verificado antes dos testes
+    llm_check = asyncio.create_task(_check_llm())
 
     script_dir = os.path.dirname(os.path.abspath(__file__))
     mcp_servers_dir = os.path.join(script_dir, "mcp-servers")
@@ -597,6 +1349,7 @@ async def main():
 
     if not all(os.path.exists(p) for p in [math_server_path, weather_server_path, sqlite_server_path]):
         print(f"ERRO: Scripts dos servidores MCP não encontrados em {mcp_servers_dir}")
+        llm_check.cancel()
         return
         
     if not os.path.exists(db_file_path):
@@ -605,20 +1358,28 @@ async def main():
         print(f"AVISO: Base de dados não encontrada em {db_file_path}. A execução pode falhar se for necessária.")
         # Poderíamos adicionar lógica para criar um DB vazio aqui se necessário
 
-    mcp_server_config = {
-         "math": {"command": sys.executable, "args": [math_server_path], "transport": "stdio"},
-         "weather": {"command": sys.executable, "args": [weather_server_path], "transport": "stdio"},
-         "sqlite": {"command": sys.executable, "args": [sqlite_server_path, "--db-path", db_file_path], "transport": "stdio"}
+    mcp_server_commands = {
+         "math": [sys.executable, math_server_path],
+         "weather": [sys.executable, weather_server_path],
+         "sqlite": [sys.executable, sqlite_server_path, "--db-path", db_file_path],
     }
 
-    print("A iniciar cliente MCP e servidores locais via stdio...")
+    print(f"A iniciar cliente MCP e servidores locais via {MCP_TRANSPORT}...")
+    # O cliente MCP vive num event loop próprio, partilhado por todos os nós do agente
+    mcp_loop_thread = AsyncLoopThread()
+    mcp_loop_thread.start()
     try:
-        async with MultiServerMCPClient(mcp_server_config) as mcp_client:
+        async with LocalMCPServers(mcp_server_commands) as mcp_server_config, \
+                MCPClientWrapper(mcp_server_config, mcp_loop_thread) as mcp_client:
             print("Cliente MCP pronto. A obter ferramentas...")
             try:
-                # get_tools() é síncrono
-                mcp_tools_list: List[BaseTool] = mcp_client.get_tools()
+                mcp_tools_list: List[BaseTool] = await mcp_client.list_tools()
                 mcp_tools_dict = {tool.name: tool for tool in mcp_tools_list}
+                # Novo cliente MCP: descartar caches da ligação anterior
+                _retrieve_tools_cached.cache_clear()
+                tool_run_cache.clear()
+                _format_tool_for_prompt.cache_clear()
+                _llm_with_tool.cache_clear()
                 print(f"Ferramentas MCP carregadas: {list(mcp_tools_dict.keys())}")
                 
                 if not mcp_tools_dict:
@@ -629,48 +1390,55 @@ async def main():
                 print(f"ERRO ao obter ferramentas do cliente MCP: {e}")
                 return
 
-            # Instanciar o Agente LangGraph
-            agent_builder = CustomAgent(
-                state_schema=AgentState,
-                impl=[
-                    ("supervisor", supervisor),
-                    ("react_agent", react_agent),
-                    ("codeact_agent", codeact_agent),
-                    ("final_answer", final_answer),
-                    ("conditional_edge_1", route_to_agent),
-                ],
-            )
-            compiled_agent = agent_builder.compile()
+            compiled_agent = build_agent()
+
+            if not await llm_check:
+                return
 
             print("\nExecutando testes com LLM Anthropic e ferramentas MCP...")
-            base_initial_state = {"mcp_client": mcp_client, "mcp_tools": mcp_tools_dict}
-
-            # Teste 1: ReAct Simples - Consulta de tempo (ReAct)
-            print("\n\n===== TESTE 1: PREVISÃO DO TEMPO (ReAct c/ Anthropic) =====")
-            initial_state_1 = {**base_initial_state, "messages": [HumanMessage(content="qual é o tempo em lisboa?")]}
-            async for step in compiled_agent.astream(initial_state_1): 
-                print(f"\nStep Output: {step}")
-
-            # Teste 2: CodeAct - Consulta de tempo + matemática (utiliza múltiplas ferramentas)
-            print("\n\n===== TESTE 2: TAREFA MULTI-FERRAMENTA (CodeAct c/ Anthropic) =====")
-            initial_state_2 = {**base_initial_state, "messages": [HumanMessage(content="qual é o tempo em porto e calcula a soma de 10 e 5?")]}
-            async for step in compiled_agent.astream(initial_state_2): 
-                print(f"\nStep Output: {step}")
-
-            # Teste 3: SQL - Listar tabelas
-            print("\n\n===== TESTE 3: LISTAR TABELAS SQLITE (ReAct c/ Anthropic) =====")
-            initial_state_3 = {**base_initial_state, "messages": [HumanMessage(content="lista as tabelas da base de dados de viagens")]}
-            async for step in compiled_agent.astream(initial_state_3): 
-                print(f"\nStep Output: {step}")
+            async def run_test(name: str, title: str, initial_state: dict) -> None:
+                print(f"\n\n===== {name}: {title} =====")
+                # Cada teste corre na sua própria tarefa (gather): o prefixo só afeta este teste
+                _STREAM_PREFIX.set(name)
+                # run_id próprio: identifica a geração especulativa desta execução
+                run_config = {"configurable": {"mcp_client": mcp_client, "mcp_tools": mcp_tools_dict, "run_id": str(uuid.uuid4())}}
+                try:
+                    async for step in compiled_agent.astream(initial_state, config=run_config):
+                        print(f"\n[{name}] Step Output: {step}")
+                finally:
+                    _discard_speculative_call(run_config)
+
+            # Os três testes são independentes (partilham apenas ferramentas e cliente MCP): correr em concorrência
+            await asyncio.gather(
+                # Teste 1: ReAct Simples - Consulta de tempo (ReAct)
+                run_test("TESTE 1", "PREVISÃO DO TEMPO (ReAct c/ Anthropic)",
+                         {"messages": [HumanMessage(content="qual é o tempo em lisboa?")]}),
+                # Teste 2: CodeAct - Consulta de tempo + matemática (utiliza múltiplas ferramentas)
+                run_test("TESTE 2", "TAREFA MULTI-FERRAMENTA (CodeAct c/ Anthropic)",
+                         {"messages": [HumanMessage(content="qual é o tempo em porto e calcula a soma de 10 e 5?")]}),
+                # Teste 3: SQL - Listar tabelas
+                run_test("TESTE 3", "LISTAR TABELAS SQLITE (ReAct c/ Anthropic)",
+                         {"messages": [HumanMessage(content="lista as tabelas da base de dados de viagens")]}),
+            )
 
             print("\nTestes concluídos com sucesso!")
 
     except Exception as e:
         print(f"\nERRO GERAL DURANTE A EXECUÇÃO: {e}")
         import traceback; print(traceback.format_exc())
+    finally:
+        llm_check.cancel()
+        mcp_loop_thread.stop()
 
 # --- Ponto de Entrada ---
 if __name__ == "__main__":
+    # Event loop uvloop (libuv) quando disponível; o loop da AsyncLoopThread herda a mesma política
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
     # Adicionar tratamento para SIGINT (Ctrl+C) para fechar cliente MCP graciosamente
     try:
         asyncio.run(main())
@@ -0,0 +1,14 @@
+# event_loop.py
+import sys
+
+
+def install_uvloop() -> bool:
+    """Usa o uvloop (libuv) como event loop asyncio, se estiver instalado; não existe em Windows."""
+    if sys.platform == "win32":
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    uvloop.install()
+    return True
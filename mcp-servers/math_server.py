@@ -1,5 +1,7 @@
 # math_server.py
+import argparse
 from mcp.server.fastmcp import FastMCP
+from event_loop import install_uvloop
 
 mcp = FastMCP("Math")
 
@@ -14,4 +16,13 @@ def multiply(a: int, b: int) -> int:
     return a * b
 
 if __name__ == "__main__":
-    mcp.run(transport="stdio")
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transport", choices=["stdio", "sse"], default="stdio")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    install_uvloop()
+    # Só na interface loopback: as ferramentas não têm autenticação (o FastMCP escuta em 0.0.0.0 por omissão)
+    mcp.settings.host = "127.0.0.1"
+    mcp.settings.port = args.port
+    mcp.settings.log_level = "WARNING"
+    mcp.run(transport=args.transport)
\ No newline at end of file
@@ -1,44 +1,107 @@
 import sqlite3
+import atexit
+import functools
+import threading
 import argparse
-from typing import List, Dict, Any, Union
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from cachetools import TTLCache
+from typing import List, Dict, Any, Optional, Union
 from mcp.server.fastmcp import FastMCP
+from event_loop import install_uvloop
+from tool_errors import ToolError, tool_error
 import os
 
+# --- Logging ---
+# Os pedidos só colocam registos numa fila; uma thread de fundo escreve-os em stderr
+# (no transporte stdio, o stdout é o canal do protocolo MCP)
+_LOG_QUEUE: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler(sys.stderr)
+_log_stream_handler.setFormatter(logging.Formatter("--- [SQLite Server] %(message)s ---"))
+_LOG_LISTENER = QueueListener(_LOG_QUEUE, _log_stream_handler)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+
+log = logging.getLogger("sqlite_server")
+log.setLevel(logging.INFO)
+log.addHandler(QueueHandler(_LOG_QUEUE))
+log.propagate = False
+
 # --- Funções Auxiliares DB ---
 
-def _get_db_connection(db_path: str) -> sqlite3.Connection:
-    """Estabelece conexão com a base de dados SQLite."""
-    try:
-        conn = sqlite3.connect(db_path)
-        # Retorna linhas como dicionários
-        conn.row_factory = sqlite3.Row
-        return conn
-    except sqlite3.Error as e:
-        print(f"Erro ao conectar a DB {db_path}: {e}")
-        raise # Re-levanta a excepção para ser capturada pela ferramenta
+def _execute_query(query: str, params=(), fetch_all=False, max_rows: Optional[int] = None) -> Union[List[Dict[str, Any]], int, None]:
+    """Executa uma query na ligação persistente (ver _CONN abaixo).
 
-def _execute_query(db_path: str, query: str, params=(), fetch_all=False) -> Union[List[Dict[str, Any]], int, None]:
-    """Executa uma query e fecha a conexão."""
-    conn = None
+    Com `max_rows`, a leitura pára após `max_rows + 1` linhas: o chamador sabe que o resultado
+    foi cortado se receber mais de `max_rows` linhas."""
     try:
-        conn = _get_db_connection(db_path)
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        if fetch_all:
-            rows = cursor.fetchall()
-            # Converte sqlite3.Row para dicionários
-            return [dict(row) for row in rows]
-        else:
-            # Para INSERT, UPDATE, DELETE, commit e retorna linhas afetadas
-            conn.commit()
+        with _LOCK:
+            cursor = _CONN.execute(query, params)
+            if fetch_all:
+                # Converte tuplos em dicionários com os nomes das colunas (sem objetos sqlite3.Row intermédios)
+                cols = [d[0] for d in cursor.description]
+                limit = None if max_rows is None else max_rows + 1
+                results = []
+                while limit is None or len(results) < limit:
+                    batch = 1000 if limit is None else min(1000, limit - len(results))
+                    rows = cursor.fetchmany(batch)
+                    if not rows:
+                        break
+                    results.extend([dict(zip(cols, row)) for row in rows])
+                return results
+            # Para INSERT, UPDATE, DELETE retorna linhas afetadas (autocommit)
             return cursor.rowcount
     except sqlite3.Error as e:
-        print(f"Erro DB ao executar query '{query[:50]}...': {e}")
+        log.error("Erro DB ao executar query '%.50s...': %s", query, e)
         # Retorna o erro como string para o agente
-        raise ValueError(f"Erro SQLite: {e}")
-    finally:
-        if conn:
-            conn.close()
+        raise ValueError(f"Erro SQLite: {e}") from e
+
+def _db_error(prefix: str, e: Exception) -> Dict[str, Any]:
+    """Erro estruturado para falhas da base de dados; só bloqueios (locked/busy) são transitórios."""
+    cause = e.__cause__ if isinstance(e.__cause__, sqlite3.Error) else e
+    retryable = isinstance(cause, sqlite3.OperationalError) and ("locked" in str(cause) or "busy" in str(cause))
+    return tool_error(ToolError.DB_ERROR, f"{prefix}: {e}", retryable=retryable)
+
+def _ttl_cached(ttl: float, maxsize: int = 128):
+    """Memoiza o resultado da função durante `ttl` segundos, por argumentos, até `maxsize` entradas
+    (as expiradas e as menos usadas são removidas). Exceções e resultados vazios não ficam em cache."""
+    def decorator(func):
+        cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            hit = cache.get(args)
+            if hit is not None:
+                return hit
+            result = func(*args)
+            # Vazio (ex.: tabela inexistente em describe_table) pode deixar de o ser a qualquer momento
+            if result:
+                cache[args] = result
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+# SQL constante para que o cache de statements do sqlite3 seja reutilizado
+_LIST_TABLES_SQL = "SELECT name FROM sqlite_master WHERE type='table';"
+# Função tabela pragma_table_info com parâmetro: mesmo SQL para todas as tabelas e sem risco de injeção
+_TABLE_INFO_SQL = "SELECT * FROM pragma_table_info(?);"
+
+# Esquema raramente muda durante uma sessão: memoizar as consultas de introspeção
+@_ttl_cached(30.0)
+def _fetch_table_names() -> List[str]:
+    tables = _execute_query(_LIST_TABLES_SQL, fetch_all=True)
+    return [table['name'] for table in tables if table['name'] != 'sqlite_sequence']
+
+@_ttl_cached(30.0)
+def _fetch_table_info(table_name: str) -> List[Dict[str, Any]]:
+    return _execute_query(_TABLE_INFO_SQL, params=(table_name,), fetch_all=True)
+
+# Máximo de linhas devolvidas por read_query (memória do servidor e tamanho da resposta MCP)
+READ_QUERY_MAX_ROWS = 10000
 
 # --- Servidor MCP ---
 
@@ -47,76 +110,93 @@ mcp = FastMCP("SQLiteDB") # Nome do servidor
 # Obtém o caminho da DB a partir dos argumentos ou usa um default
 parser = argparse.ArgumentParser()
 parser.add_argument("--db-path", default="local_test.db", help="Caminho para o ficheiro da base de dados SQLite.")
+parser.add_argument("--transport", choices=["stdio", "sse"], default="stdio")
+parser.add_argument("--port", type=int, default=8000)
 # Nota: O FastMCP/MCP pode ter a sua própria forma de lidar com args,
 # mas vamos ler aqui para passar para as funções.
 # Idealmente, o estado do servidor manteria o db_path.
 # Por simplicidade aqui, vamos ler uma vez.
 cli_args, _ = parser.parse_known_args()
 DB_PATH = os.path.abspath(cli_args.db_path) # Usar caminho absoluto
-print(f"--- [SQLite Server] Usando DB em: {DB_PATH} ---")
+log.info("Usando DB em: %s", DB_PATH)
 # Cria o ficheiro DB se não existir (e o diretório)
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 # Touch para criar se não existir (ou pode ser criado na primeira conexão)
 with open(DB_PATH, 'a'): os.utime(DB_PATH, None)
 
+# Ligação única, reutilizada por todas as ferramentas (o servidor stdio é um só processo).
+# isolation_level=None: modo autocommit, não é preciso chamar commit() após escritas.
+_CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+_CONN.execute("PRAGMA journal_mode=WAL;")
+_CONN.execute("PRAGMA synchronous=NORMAL;")
+_CONN.execute("PRAGMA temp_store=MEMORY;")
+_CONN.execute("PRAGMA cache_size=-64000;")
+_LOCK = threading.Lock()
+atexit.register(_CONN.close)
+
 # --- Ferramentas MCP ---
 
 @mcp.tool()
-def list_tables() -> Union[List[str], str]:
+def list_tables() -> Union[List[str], Dict[str, Any]]:
     """Lista todas as tabelas na base de dados SQLite."""
-    print("--- [SQLite Server] Executando list_tables ---")
+    log.info("Executando list_tables")
     try:
-        tables = _execute_query(DB_PATH, "SELECT name FROM sqlite_master WHERE type='table';", fetch_all=True)
-        return [table['name'] for table in tables if table['name'] != 'sqlite_sequence']
-    except Exception as e:
-        return f"Erro ao listar tabelas: {e}"
+        return _fetch_table_names()
+    except ValueError as e:
+        return _db_error("Erro ao listar tabelas", e)
 
 @mcp.tool()
-def describe_table(table_name: str) -> Union[List[Dict[str, Any]], str]:
+def describe_table(table_name: str) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
     """Descreve as colunas de uma tabela específica."""
-    print(f"--- [SQLite Server] Executando describe_table para '{table_name}' ---")
-    # Validar nome da tabela minimamente para evitar injeção no PRAGMA
-    if not table_name.isalnum():
-        return "Erro: Nome da tabela inválido."
+    log.info("Executando describe_table para '%s'", table_name)
     try:
-        # Usar PRAGMA é seguro aqui pois validamos table_name
-        schema = _execute_query(DB_PATH, f"PRAGMA table_info({table_name});", fetch_all=True)
+        schema = _fetch_table_info(table_name)
         if not schema:
-             return f"Erro: Tabela '{table_name}' não encontrada ou vazia."
+             return tool_error(ToolError.NOT_FOUND, f"Erro: Tabela '{table_name}' não encontrada ou vazia.")
         return schema # Retorna a lista de dicionários como recebida
-    except Exception as e:
-        return f"Erro ao descrever tabela '{table_name}': {e}"
+    except ValueError as e:
+        return _db_error(f"Erro ao descrever tabela '{table_name}'", e)
 
 @mcp.tool()
-def read_query(query: str) -> Union[List[Dict[str, Any]], str]:
-    """Executa uma query SELECT na base de dados SQLite. Cuidado com queries complexas."""
-    print(f"--- [SQLite Server] Executando read_query: {query[:100]}... ---")
+def read_query(query: str) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """Executa uma query SELECT na base de dados SQLite. Cuidado com queries complexas.
+
+    Devolve no máximo READ_QUERY_MAX_ROWS linhas. Se o resultado for cortado, devolve
+    {"rows": [...], "truncated": True, "max_rows": N}; use LIMIT/OFFSET para obter o resto."""
+    log.info("Executando read_query: %.100s...", query)
     # Validação muito básica - permitir apenas SELECT
     if not query.strip().upper().startswith("SELECT"):
-        return "Erro: Apenas queries SELECT são permitidas em read_query."
+        return tool_error(ToolError.INVALID_INPUT, "Erro: Apenas queries SELECT são permitidas em read_query.")
     try:
-        results = _execute_query(DB_PATH, query, fetch_all=True)
+        results = _execute_query(query, fetch_all=True, max_rows=READ_QUERY_MAX_ROWS)
+        if len(results) > READ_QUERY_MAX_ROWS:
+            log.info("read_query cortado em %d linhas", READ_QUERY_MAX_ROWS)
+            return {"rows": results[:READ_QUERY_MAX_ROWS], "truncated": True, "max_rows": READ_QUERY_MAX_ROWS}
         return results
-    except Exception as e:
-        return f"Erro ao executar read_query: {e}"
+    except ValueError as e:
+        return _db_error("Erro ao executar read_query", e)
 
 @mcp.tool()
-def write_query(query: str) -> Union[Dict[str, int], str]:
+def write_query(query: str) -> Dict[str, Any]:
     """Executa uma query INSERT, UPDATE ou DELETE na base de dados SQLite. USAR COM EXTREMO CUIDADO!"""
-    print(f"--- [SQLite Server] Executando write_query: {query[:100]}... ---")
+    log.info("Executando write_query: %.100s...", query)
     query_upper = query.strip().upper()
     # Validação básica - permitir apenas INSERT, UPDATE, DELETE
     if not (query_upper.startswith("INSERT") or query_upper.startswith("UPDATE") or query_upper.startswith("DELETE")):
-        return "Erro: Apenas queries INSERT, UPDATE ou DELETE são permitidas em write_query."
+        return tool_error(ToolError.INVALID_INPUT, "Erro: Apenas queries INSERT, UPDATE ou DELETE são permitidas em write_query.")
     try:
-        affected_rows = _execute_query(DB_PATH, query, fetch_all=False)
+        affected_rows = _execute_query(query, fetch_all=False)
         return {"affected_rows": affected_rows if affected_rows is not None else 0}
-    except Exception as e:
-        return f"Erro ao executar write_query: {e}"
+    except ValueError as e:
+        return _db_error("Erro ao executar write_query", e)
 
 # --- Iniciar Servidor ---
 if __name__ == "__main__":
-    print(f"--- [SQLite Server] Iniciando com transporte stdio e DB em {DB_PATH}... ---")
-    # Passar argumentos relevantes para mcp.run se a biblioteca suportar,
-    # caso contrário, eles já foram lidos acima.
-    mcp.run(transport="stdio")
+    log.info("Iniciando com transporte %s e DB em %s...", cli_args.transport, DB_PATH)
+    install_uvloop()
+    # Os argumentos já foram lidos acima; o porto só é usado pelos transportes HTTP
+    # Só na interface loopback: as ferramentas não têm autenticação (o FastMCP escuta em 0.0.0.0 por omissão)
+    mcp.settings.host = "127.0.0.1"
+    mcp.settings.port = cli_args.port
+    mcp.settings.log_level = "WARNING"
+    mcp.run(transport=cli_args.transport)
@@ -0,0 +1,30 @@
+# tool_errors.py
+from enum import Enum
+from typing import Any, Dict, Optional
+
+
+class ToolError(Enum):
+    """Códigos de erro partilhados pelas ferramentas dos servidores MCP locais."""
+    INVALID_INPUT = "invalid_input"
+    NOT_FOUND = "not_found"
+    UPSTREAM_HTTP_ERROR = "upstream_http_error"
+    DB_ERROR = "db_error"
+
+
+# Por omissão, só falhas do serviço externo justificam repetir a mesma chamada
+_RETRYABLE_BY_DEFAULT = {ToolError.UPSTREAM_HTTP_ERROR}
+
+
+def tool_error(code: ToolError, message: str, retryable: Optional[bool] = None) -> Dict[str, Any]:
+    """Resultado de erro estruturado: o agente decide pelo `code`/`retryable` sem interpretar o texto."""
+    return {
+        "isError": True,
+        "code": code.name,
+        "retryable": code in _RETRYABLE_BY_DEFAULT if retryable is None else retryable,
+        "content": [
+            {
+                "type": "text",
+                "text": message
+            }
+        ]
+    }
@@ -1,9 +1,15 @@
+import argparse
+import asyncio
 import os
 import aiohttp
 import json
+import time
+from collections import OrderedDict
 from typing import List, Dict, Optional, Union, Any
 from dotenv import load_dotenv
 from mcp.server.fastmcp import FastMCP
+from event_loop import install_uvloop
+from tool_errors import ToolError, tool_error
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -12,8 +18,26 @@ load_dotenv()
 API_KEY = os.getenv("OPENWEATHER_API_KEY")
 BASE_URL = "https://api.openweathermap.org/data/2.5/weather"
 
+# Sessão HTTP partilhada: reutiliza ligações TCP/TLS entre chamadas a get_weather
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+async def _session() -> aiohttp.ClientSession:
+    """Devolve a sessão aiohttp partilhada, criando-a na primeira utilização."""
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+    return _SESSION
+
 mcp = FastMCP("Weather")
 
+# Cache LRU com TTL das respostas de get_weather: o tempo não muda à escala do minuto
+_WEATHER_CACHE: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+_WEATHER_CACHE_TTL = 300.0
+_WEATHER_CACHE_MAXSIZE = 256
+
 @mcp.tool()
 async def get_weather(location: str) -> Dict[str, Any]:
     """
@@ -26,16 +50,19 @@ async def get_weather(location: str) -> Dict[str, Any]:
         Informações detalhadas sobre o tempo atual na localização solicitada.
     """
     if not location or not isinstance(location, str):
-        return {
-            "isError": True,
-            "content": [
-                {
-                    "type": "text",
-                    "text": "Erro: A localização deve ser uma string válida."
-                }
-            ]
-        }
+        return tool_error(ToolError.INVALID_INPUT, "Erro: A localização deve ser uma string válida.")
     
+    # Respostas recentes em cache (apenas sucessos), por localização normalizada
+    cache_key = location.strip().lower()
+    now = time.monotonic()
+    hit = _WEATHER_CACHE.get(cache_key)
+    if hit and now - hit[0] < _WEATHER_CACHE_TTL:
+        _WEATHER_CACHE.move_to_end(cache_key)
+        return hit[1]
+
+    if not API_KEY:
+        return tool_error(ToolError.UPSTREAM_HTTP_ERROR, "Erro: OPENWEATHER_API_KEY não está configurada no servidor.", retryable=False)
+
     try:
         params = {
             "q": location,
@@ -44,73 +71,61 @@ async def get_weather(location: str) -> Dict[str, Any]:
             "lang": "pt"        # Para descrições em português
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(BASE_URL, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Formatar a resposta
-                    city_name = data["name"]
-                    country = data.get("sys", {}).get("country", "")
-                    temp = data["main"]["temp"]
-                    feels_like = data["main"]["feels_like"]
-                    humidity = data["main"].get("humidity", "N/A")
-                    weather_desc = data["weather"][0]["description"]
-                    wind_speed = data.get("wind", {}).get("speed", "N/A")
-                    
-                    formatted_response = {
-                        "cidade": city_name,
-                        "país": country,
-                        "temperatura": f"{temp}°C",
-                        "sensação térmica": f"{feels_like}°C",
-                        "humidade": f"{humidity}%",
-                        "condições": weather_desc,
-                        "vento": f"{wind_speed} m/s"
-                    }
-                    
-                    return {
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"Tempo atual em {city_name}, {country}: {temp}°C, {weather_desc}. Sensação térmica de {feels_like}°C, humidade de {humidity}% e vento a {wind_speed} m/s."
-                            },
-                            {
-                                "type": "json",
-                                "json": formatted_response
-                            }
-                        ]
-                    }
-                elif response.status == 404:
-                    return {
-                        "isError": True,
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"Erro: Localização '{location}' não encontrada. Verifique o nome da cidade e tente novamente."
-                            }
-                        ]
-                    }
-                else:
-                    error_data = await response.text()
-                    return {
-                        "isError": True,
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"Erro ao consultar serviço de meteorologia: {response.status} - {error_data}"
-                            }
-                        ]
-                    }
-    except Exception as e:
-        return {
-            "isError": True,
-            "content": [
-                {
-                    "type": "text",
-                    "text": f"Erro ao processar pedido: {str(e)}"
+        session = await _session()
+        async with session.get(BASE_URL, params=params) as response:
+            if response.status == 200:
+                data = await response.json()
+                
+                # Formatar a resposta
+                city_name = data["name"]
+                country = data.get("sys", {}).get("country", "")
+                temp = data["main"]["temp"]
+                feels_like = data["main"]["feels_like"]
+                humidity = data["main"].get("humidity", "N/A")
+                weather_desc = data["weather"][0]["description"]
+                wind_speed = data.get("wind", {}).get("speed", "N/A")
+                
+                formatted_response = {
+                    "cidade": city_name,
+                    "país": country,
+                    "temperatura": f"{temp}°C",
+                    "sensação térmica": f"{feels_like}°C",
+                    "humidade": f"{humidity}%",
+                    "condições": weather_desc,
+                    "vento": f"{wind_speed} m/s"
                 }
-            ]
-        }
+                
+                result = {
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": f"Tempo atual em {city_name}, {country}: {temp}°C, {weather_desc}. Sensação térmica de {feels_like}°C, humidade de {humidity}% e vento a {wind_speed} m/s."
+                        },
+                        {
+                            "type": "json",
+                            "json": formatted_response
+                        }
+                    ]
+                }
+                _WEATHER_CACHE[cache_key] = (now, result)
+                _WEATHER_CACHE.move_to_end(cache_key)
+                if len(_WEATHER_CACHE) > _WEATHER_CACHE_MAXSIZE:
+                    _WEATHER_CACHE.popitem(last=False)
+                return result
+            elif response.status == 404:
+                return tool_error(ToolError.NOT_FOUND, f"Erro: Localização '{location}' não encontrada. Verifique o nome da cidade e tente novamente.")
+            else:
+                error_data = await response.text()
+                # Limite de taxa e falhas do servidor são transitórios; 401/400 não mudam ao repetir
+                return tool_error(
+                    ToolError.UPSTREAM_HTTP_ERROR,
+                    f"Erro ao consultar serviço de meteorologia: {response.status} - {error_data}",
+                    retryable=response.status == 429 or response.status >= 500,
+                )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return tool_error(ToolError.UPSTREAM_HTTP_ERROR, f"Erro de ligação ao serviço de meteorologia: {e!r}")
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        return tool_error(ToolError.UPSTREAM_HTTP_ERROR, f"Erro ao processar resposta do serviço de meteorologia: {e!r}", retryable=False)
 
 # Versão simplificada para compatibilidade com implementações antigas
 @mcp.tool()
@@ -129,5 +144,26 @@ async def get_weather_simple(location: str) -> str:
     # Retorna apenas a parte em texto da resposta
     return result["content"][0]["text"]
 
+async def _serve(transport: str) -> None:
+    """Corre o servidor MCP e fecha a sessão HTTP partilhada só quando o processo termina.
+    O lifespan do FastMCP é executado por ligação SSE, pelo que não serve para a fechar."""
+    try:
+        if transport == "sse":
+            await mcp.run_sse_async()
+        else:
+            await mcp.run_stdio_async()
+    finally:
+        if _SESSION is not None and not _SESSION.closed:
+            await _SESSION.close()
+
 if __name__ == "__main__":
-    mcp.run(transport="stdio")  
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transport", choices=["stdio", "sse"], default="stdio")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    install_uvloop()
+    # Só na interface loopback: as ferramentas não têm autenticação (o FastMCP escuta em 0.0.0.0 por omissão)
+    mcp.settings.host = "127.0.0.1"
+    mcp.settings.port = args.port
+    mcp.settings.log_level = "WARNING"
+    asyncio.run(_serve(args.transport))  
\ No newline at end of file